@@ -0,0 +1,319 @@
+"""
+Benchmark suite for the routing pipeline, runnable offline.
+
+Times each stage across grid densities and reports JSON:
+- queue: MinPriorityQueue enqueue/decrease/drain over grid_density^2 nodes
+- adjacency: build_adjacency_list over the grid's edges
+- dijkstra: search over the materialised edge list with precomputed random edge costs
+- grid_dijkstra: the same search over the implicit GridGraph the handler uses
+- grid: RouteGrid construction plus edge and segment enumeration
+- handler: the full /optimum_ef_route handler
+
+The handler runs against synthetic ERA5-like met slices and a synthetic
+CoCiP whose EF is a smooth analytic field, so no CDS access is needed. Its
+EF stage therefore measures the batching and Fleet overhead around CoCiP,
+not CoCiP itself.
+
+    python bench_pipeline.py --grid-densities 6 12 24 --repeat 3 --output bench.json
+"""
+import argparse
+import json
+import os
+import time
+import tracemalloc
+from array import array
+from datetime import datetime
+
+os.environ.setdefault("EF_MAX_WORKERS", "1")
+# Repeated handler runs would otherwise read every segment back from the EF store
+os.environ.setdefault("EF_STORE_ENABLED", "0")
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import main
+from bench_queue import MinPriorityQueue, make_workload, run_queue
+from routing import IndexedMinHeap, flat_cost_fn, grid_dijkstra
+
+START_TIME = datetime(2026, 2, 7, 12)
+ROUTE = dict(start_long=-0.45, start_lat=51.47, end_long=2.55, end_lat=49.0)
+
+
+def _variable_name(variable):
+    # Alternatives come as tuples; the first one is what ERA5 would provide
+    if isinstance(variable, (tuple, list)):
+        variable = variable[0]
+    return getattr(variable, "standard_name", None) or getattr(variable, "short_name", variable)
+
+
+def synthetic_met_slice(start_time, end_time, variables, pressure_levels=None, bbox=None, seed=0):
+    """A MetDataset shaped like an ERA5 slice over ``bbox`` (or the benchmark route), filled with noise."""
+    rng = np.random.default_rng(seed)
+    lon_min, lon_max, lat_min, lat_max = bbox or (-10.0, 10.0, 40.0, 60.0)
+    coords = {
+        "longitude": np.arange(lon_min, lon_max + 0.125, 0.25),
+        "latitude": np.arange(lat_min, lat_max + 0.125, 0.25),
+        "level": np.asarray(sorted(pressure_levels), dtype=float) if pressure_levels else np.array([-1.0]),
+        "time": pd.date_range(
+            pd.Timestamp(start_time).floor("h"), pd.Timestamp(end_time).ceil("h"), freq="1h"
+        ).values,
+    }
+    shape = tuple(len(values) for values in coords.values())
+    ds = xr.Dataset(
+        {
+            _variable_name(variable): (tuple(coords), rng.random(shape, dtype=np.float32))
+            for variable in variables
+        },
+        coords=coords,
+    )
+    return main.MetDataset(ds)
+
+
+class SyntheticCocip:
+    """Stands in for Cocip: EF is a smooth function of position, no contrail physics."""
+
+    met_variables = main.Cocip.met_variables
+    rad_variables = main.Cocip.rad_variables
+
+    def __init__(self, met, rad, aircraft_performance=None, **params):
+        self.met = met
+        self.rad = rad
+
+    def eval(self, source):
+        lon = np.asarray(source["longitude"], dtype=float)
+        lat = np.asarray(source["latitude"], dtype=float)
+        alt = np.asarray(source["altitude_ft"], dtype=float)
+        source["ef"] = 1e8 * np.sin(lon * 0.9) * np.cos(lat * 0.7) * (alt / 35000.0)
+        return source
+
+
+def use_synthetic_met():
+    """Point the API module at synthetic met and CoCiP, and drop its caches."""
+    main.load_met_slice = synthetic_met_slice
+    main.Cocip = SyntheticCocip
+    main.get_met_context.cache_clear()
+
+
+def build_adjacency_list(edges):
+    adj = {}
+    for a, b, w in edges:
+        adj.setdefault(a, []).append((b, w))
+        adj.setdefault(b, []).append((a, w))
+    return adj
+
+
+def dijkstra(edges, start, end, cost_fn, stats=None):
+    """Cheapest path from start to end over a materialised edge list.
+
+    The baseline grid_dijkstra is measured against: edges are walked both
+    ways, as build_adjacency_list stores them, and priced by
+    ``cost_fn(node_from, node_to)``. If ``stats`` is a dict, it is filled
+    with ``nodes_expanded`` and ``edges_relaxed`` counters.
+    """
+    adj = build_adjacency_list(edges)
+    if start not in adj:
+        return float('inf'), []
+
+    # Map nodes to dense integer IDs so the search runs on flat buffers
+    nodes = list(adj)
+    node_ids = {node: k for k, node in enumerate(nodes)}
+    neighbors = [[node_ids[b] for b, _w in adj[node]] for node in nodes]
+    start_id, end_id = node_ids[start], node_ids.get(end, -1)
+
+    pq = IndexedMinHeap(len(nodes))
+    dist = array('d', [float('inf')]) * len(nodes)
+    prev = array('l', [-1]) * len(nodes)
+    dist[start_id] = 0.0
+    pq.enqueue(start_id, 0.0)
+    expansions = relaxed = 0
+
+    while pq:
+        current, current_dist = pq.dequeue_min()
+        if current == end_id:
+            break
+        expansions += 1
+        for neighbor in neighbors[current]:
+            new_dist = current_dist + cost_fn(nodes[current], nodes[neighbor])
+            relaxed += 1
+            if new_dist < dist[neighbor]:
+                dist[neighbor] = new_dist
+                prev[neighbor] = current
+                if neighbor in pq:
+                    pq.decrease_value(neighbor, new_dist)
+                else:
+                    pq.enqueue(neighbor, new_dist)
+
+    if stats is not None:
+        stats.update(nodes_expanded=expansions, edges_relaxed=relaxed)
+    if end_id < 0 or dist[end_id] == float('inf'):
+        return float('inf'), []
+
+    path = []
+    node = end_id
+    while node >= 0:
+        path.append(nodes[node])
+        node = prev[node]
+    path.reverse()
+    return dist[end_id], path
+
+
+def layer_cost_fn(edge_costs):
+    """Wrap a precomputed ``(n_cols - 1, n_rows, n_rows)`` cost array as a cost_fn for dijkstra.
+
+    Forward edges (i, j1) -> (i + 1, j2) read ``edge_costs[i, j1, j2]``, and
+    the backward edges build_adjacency_list adds read the mirrored index.
+    The array is converted to nested lists once, since indexing Python
+    lists is much cheaper than NumPy scalar access in the search loop.
+    """
+    costs = np.asarray(edge_costs, dtype=float).tolist()
+
+    def cost_fn(coord_from, coord_to):
+        i_a, j_a = coord_from
+        i_b, j_b = coord_to
+        if i_b == i_a + 1:
+            return costs[i_a][j_a][j_b]
+        return costs[i_b][j_b][j_a]
+
+    return cost_fn
+
+
+def timed(fn, repeat):
+    """Best wall time over ``repeat`` runs, plus tracemalloc peak of one more run."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def bench_density(grid_density, altitudes_ft, solver, repeat, seed):
+    dat = main.FlightData(
+        grid_density=grid_density,
+        start_time=START_TIME,
+        duration_hours=2,
+        fuel_cost_per_km=0.15,
+        lambda_value=1e-8,
+        solver=solver,
+        altitudes_ft=altitudes_ft,
+        **ROUTE,
+    )
+    grid = main.build_route_grid(dat)
+    edges = grid.edges()
+    num_nodes = grid.n_cols * grid.n_states
+    rng = np.random.default_rng(seed)
+    edge_costs = grid.mask_disallowed(
+        rng.uniform(1.0, 2.0, (grid.n_cols - 1, grid.n_states, grid.n_states))
+    )
+    cost_fn = layer_cost_fn(edge_costs)
+
+    coords, values, decreases = make_workload(grid_density, 2, seed)
+    stages = {}
+
+    seconds, peak = timed(lambda: run_queue(MinPriorityQueue(), coords, values, decreases), repeat)
+    stages["queue"] = {
+        "seconds": seconds, "peak_bytes": peak,
+        "ops_per_second": (2 * len(coords) + len(decreases)) / seconds,
+    }
+
+    seconds, peak = timed(lambda: build_adjacency_list(edges), repeat)
+    stages["adjacency"] = {
+        "seconds": seconds, "peak_bytes": peak, "edges_per_second": len(edges) / seconds,
+    }
+
+    search_stats = {}
+    seconds, peak = timed(
+        lambda: dijkstra(edges, grid.start_node, grid.end_node, cost_fn, stats=search_stats),
+        repeat,
+    )
+    stages["dijkstra"] = {
+        "seconds": seconds, "peak_bytes": peak,
+        "nodes_per_second": search_stats["nodes_expanded"] / seconds,
+        "edges_per_second": search_stats["edges_relaxed"] / seconds,
+    }
+
+    graph = grid.graph()
+    edge_cost = flat_cost_fn(edge_costs[grid.edge_index()])
+    search_stats = {}
+    seconds, peak = timed(
+        lambda: grid_dijkstra(graph, grid.start_node, grid.end_node, edge_cost, stats=search_stats),
+        repeat,
+    )
+    stages["grid_dijkstra"] = {
+        "seconds": seconds, "peak_bytes": peak,
+        "nodes_per_second": search_stats["nodes_expanded"] / seconds,
+        "edges_per_second": search_stats["edges_relaxed"] / seconds,
+    }
+
+    def build_grid():
+        g = main.build_route_grid(dat)
+        g.graph()
+        g.segments()
+
+    seconds, peak = timed(build_grid, repeat)
+    stages["grid"] = {
+        "seconds": seconds, "peak_bytes": peak, "edges_per_second": len(edges) / seconds,
+    }
+
+    # Full handler with a warm met context but no cached route
+    main.get_met_context(*main.met_window(dat, grid))
+    response = {}
+
+    def handler():
+        main.route_service._results.clear()
+        response.update(main.main(dat))
+
+    seconds, peak = timed(handler, repeat)
+    stats = response["search_stats"]
+    stages["handler"] = {
+        "seconds": seconds, "peak_bytes": peak,
+        "nodes_per_second": stats["nodes_expanded"] / seconds,
+        "edges_per_second": len(edges) / seconds,
+    }
+
+    return {
+        "grid_density": grid_density,
+        "nodes": num_nodes,
+        "edges": len(edges),
+        "stages": stages,
+    }
+
+
+def run(grid_densities, altitudes_ft, solver, repeat, seed):
+    use_synthetic_met()
+    return {
+        "solver": solver,
+        "altitudes_ft": altitudes_ft,
+        "ef_max_workers": main.EF_MAX_WORKERS,
+        "results": [
+            bench_density(n, altitudes_ft, solver, repeat, seed) for n in grid_densities
+        ],
+    }
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--grid-densities", type=int, nargs="+", default=[6, 12, 24])
+    parser.add_argument("--altitudes-ft", type=float, nargs="+", default=[35000])
+    parser.add_argument("--solver", choices=["dijkstra", "astar", "dag"], default="dijkstra")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = run(args.grid_densities, args.altitudes_ft, args.solver, args.repeat, args.seed)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,184 @@
+"""
+Microbenchmark: MinPriorityQueue (tuple coords) vs IndexedMinHeap (integer IDs).
+
+Runs the same Dijkstra-like workload on both queues: enqueue every node of an
+n x n grid, apply a batch of decrease_value calls, then drain the queue.
+
+    python bench_queue.py --grid-density 200 --repeat 3
+"""
+import argparse
+import json
+import random
+import time
+import tracemalloc
+
+from routing import IndexedMinHeap
+
+
+class MinPriorityQueue:
+    def __init__(self):
+        self._heap = []                # list of [value, coord]
+        self._index_map = {}           # coord -> index in heap
+        self._value_map = {}           # coord -> current value
+
+    def _swap(self, i, j):
+        self._heap[i], self._heap[j] = self._heap[j], self._heap[i]
+        self._index_map[self._heap[i][1]] = i
+        self._index_map[self._heap[j][1]] = j
+
+    def _sift_up(self, i):
+        while i > 0:
+            parent = (i - 1) // 2
+            if self._heap[i][0] < self._heap[parent][0]:
+                self._swap(i, parent)
+                i = parent
+            else:
+                break
+
+    def _sift_down(self, i):
+        n = len(self._heap)
+        while True:
+            smallest = i
+            left = 2 * i + 1
+            right = 2 * i + 2
+            if left < n and self._heap[left][0] < self._heap[smallest][0]:
+                smallest = left
+            if right < n and self._heap[right][0] < self._heap[smallest][0]:
+                smallest = right
+            if smallest != i:
+                self._swap(i, smallest)
+                i = smallest
+            else:
+                break
+
+    def enqueue(self, coord, value):
+        """Insert a coordinate with an associated value."""
+        if coord in self._index_map:
+            raise ValueError(f"{coord} already in queue. Use decrease_value() instead.")
+        entry = [value, coord]
+        self._heap.append(entry)
+        idx = len(self._heap) - 1
+        self._index_map[coord] = idx
+        self._value_map[coord] = value
+        self._sift_up(idx)
+
+    def dequeue_min(self):
+        """Remove and return (coord, value) with the smallest value."""
+        if not self._heap:
+            raise IndexError("dequeue from empty queue")
+        self._swap(0, len(self._heap) - 1)
+        value, coord = self._heap.pop()
+        del self._index_map[coord]
+        del self._value_map[coord]
+        if self._heap:
+            self._sift_down(0)
+        return coord, value
+
+    def decrease_value(self, coord, new_value):
+        """Decrease the value associated with a coordinate.
+        
+        Raises ValueError if new_value is not strictly less than current value.
+        """
+        if coord not in self._index_map:
+            raise KeyError(f"{coord} not found in queue")
+        old_value = self._value_map[coord]
+        if new_value >= old_value:
+            raise ValueError(f"New value {new_value} must be less than current value {old_value}")
+        idx = self._index_map[coord]
+        self._heap[idx][0] = new_value
+        self._value_map[coord] = new_value
+        self._sift_up(idx)
+
+    def peek_min(self):
+        """Return (coord, value) with the smallest value without removing it."""
+        if not self._heap:
+            raise IndexError("peek from empty queue")
+        return self._heap[0][1], self._heap[0][0]
+
+    def get_value(self, coord):
+        """Return the current value associated with a coordinate."""
+        return self._value_map[coord]
+
+    def __contains__(self, coord):
+        return coord in self._index_map
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __bool__(self):
+        return bool(self._heap)
+
+    def __repr__(self):
+        items = [(entry[1], entry[0]) for entry in self._heap]
+        return f"MinPriorityQueue({items})"
+
+
+def make_workload(grid_density, decreases_per_node, seed):
+    rng = random.Random(seed)
+    coords = [(i, j) for i in range(grid_density) for j in range(grid_density)]
+    values = [rng.uniform(1000.0, 2000.0) for _ in coords]
+    decreases = []
+    current = list(values)
+    for _ in range(decreases_per_node * len(coords)):
+        k = rng.randrange(len(coords))
+        current[k] -= rng.uniform(0.0, 10.0)
+        decreases.append((k, current[k]))
+    return coords, values, decreases
+
+
+def run_queue(queue, keys, values, decreases):
+    for key, value in zip(keys, values):
+        queue.enqueue(key, value)
+    for k, value in decreases:
+        queue.decrease_value(keys[k], value)
+    while queue:
+        queue.dequeue_min()
+
+
+def bench(name, make_queue, keys, values, decreases, repeat):
+    times = []
+    for _ in range(repeat):
+        queue = make_queue()
+        start = time.perf_counter()
+        run_queue(queue, keys, values, decreases)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    queue = make_queue()
+    for key, value in zip(keys, values):
+        queue.enqueue(key, value)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "queue": name,
+        "best_seconds": min(times),
+        "ops_per_second": (2 * len(keys) + len(decreases)) / min(times),
+        "peak_bytes_full_queue": peak,
+        "bytes_per_node": peak / len(keys),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--grid-density", type=int, default=150)
+    parser.add_argument("--decreases-per-node", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    coords, values, decreases = make_workload(
+        args.grid_density, args.decreases_per_node, args.seed
+    )
+    ids = list(range(len(coords)))
+
+    results = [
+        bench("MinPriorityQueue", MinPriorityQueue, coords, values, decreases, args.repeat),
+        bench("IndexedMinHeap", lambda: IndexedMinHeap(len(ids)), ids, values, decreases, args.repeat),
+    ]
+    results[1]["speedup"] = results[0]["best_seconds"] / results[1]["best_seconds"]
+    print(json.dumps({"nodes": len(coords), "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Precomputed contrail EF fields for fast route lookups.
+
+An EF field holds CoCiP energy forcing per km flown on a regular
+time x flight level x latitude x longitude lattice over one region, for one
+aircraft type and met window length. It is stored as a ``.npy`` array plus a
+JSON metadata file and memory-mapped on load, so many requests can share it
+without copying. Segment EF is then the field value at the segment midpoint,
+interpolated linearly along all four axes, times the segment length.
+
+The field assumes EF density does not depend on heading, which is the price
+paid for answering a route in milliseconds instead of running CoCiP.
+"""
+import json
+import os
+import threading
+import uuid
+from datetime import timezone
+
+import numpy as np
+
+from routing import haversine_km
+
+EF_FIELD_DIR = os.getenv(
+    "EF_FIELD_DIR", os.path.expanduser("~/.cache/contrail_api/ef_fields")
+)
+
+AXES = ("times", "altitudes_ft", "lats", "lons")
+
+
+def epoch_seconds(dt):
+    """Seconds since the epoch, treating naive datetimes as UTC."""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+class EFField:
+    """EF per km on a (time, altitude, lat, lon) lattice.
+
+    ``times`` are epoch seconds. Every axis must be strictly ascending.
+    """
+
+    def __init__(self, name, times, altitudes_ft, lats, lons, values,
+                 aircraft_type, duration_hours):
+        self.name = name
+        self.times = np.asarray(times, dtype=float)
+        self.altitudes_ft = np.asarray(altitudes_ft, dtype=float)
+        self.lats = np.asarray(lats, dtype=float)
+        self.lons = np.asarray(lons, dtype=float)
+        self.values = values
+        self.aircraft_type = aircraft_type
+        self.duration_hours = float(duration_hours)
+
+        expected = tuple(len(getattr(self, axis)) for axis in AXES)
+        if self.values.shape != expected:
+            raise ValueError(f"EF field values have shape {self.values.shape}, expected {expected}")
+
+    def metadata(self):
+        return {
+            "name": self.name,
+            "times": self.times.tolist(),
+            "altitudes_ft": self.altitudes_ft.tolist(),
+            "lats": self.lats.tolist(),
+            "lons": self.lons.tolist(),
+            "aircraft_type": self.aircraft_type,
+            "duration_hours": self.duration_hours,
+        }
+
+    def covers(self, start_time, lons, lats, altitudes_ft, aircraft_type, duration_hours):
+        """True if every point and the start time fall inside the lattice."""
+        if aircraft_type != self.aircraft_type or float(duration_hours) != self.duration_hours:
+            return False
+        t = epoch_seconds(start_time)
+        for axis, values in (
+                ("times", [t]), ("altitudes_ft", altitudes_ft), ("lats", lats), ("lons", lons),
+        ):
+            grid = getattr(self, axis)
+            values = np.asarray(values, dtype=float)
+            if values.min() < grid[0] or values.max() > grid[-1]:
+                return False
+        return True
+
+    def interpolate(self, start_time, lons, lats, altitudes_ft):
+        """EF per km at each point, linear along all four axes (vectorised)."""
+        lons = np.asarray(lons, dtype=float)
+        points = (
+            np.full(lons.shape, epoch_seconds(start_time)),
+            np.asarray(altitudes_ft, dtype=float),
+            np.asarray(lats, dtype=float),
+            lons,
+        )
+
+        # Lower corner index and weight of the upper corner along each axis
+        lower, weight = [], []
+        for axis, p in zip(AXES, points):
+            grid = getattr(self, axis)
+            if len(grid) == 1:
+                lower.append(np.zeros(p.shape, dtype=np.intp))
+                weight.append(np.zeros(p.shape))
+                continue
+            k = np.clip(np.searchsorted(grid, p, side="right") - 1, 0, len(grid) - 2)
+            lower.append(k)
+            weight.append((p - grid[k]) / (grid[k + 1] - grid[k]))
+
+        result = np.zeros(lons.shape)
+        for corner in range(16):
+            index, w = [], np.ones(lons.shape)
+            for d in range(4):
+                upper = (corner >> d) & 1
+                size = self.values.shape[d]
+                index.append(np.minimum(lower[d] + upper, size - 1))
+                w = w * (weight[d] if upper else 1.0 - weight[d])
+            result += w * self.values[tuple(index)]
+        return result
+
+    def segment_ef(self, start_time, segments):
+        """EF for ``((lon, lat, alt), (lon, lat, alt))`` segments, in order."""
+        if not segments:
+            return []
+        ends = np.asarray(segments, dtype=float)  # (n, 2, 3)
+        a, b = ends[:, 0], ends[:, 1]
+        mid = 0.5 * (a + b)
+        density = self.interpolate(start_time, mid[:, 0], mid[:, 1], mid[:, 2])
+        length_km = haversine_km(a[:, 0], a[:, 1], b[:, 0], b[:, 1])
+        return (density * length_km).tolist()
+
+
+def _write_atomic(path, write):
+    """Call ``write`` on a temporary file next to ``path``, then rename it over ``path``."""
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class EFFieldStore:
+    """Directory of named EF fields, memory-mapped and kept open once loaded."""
+
+    def __init__(self, directory=EF_FIELD_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._loaded = {}
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _paths(self, name):
+        base = os.path.join(self.directory, name)
+        return f"{base}.npy", f"{base}.json"
+
+    def names(self):
+        return sorted(
+            name[:-5] for name in os.listdir(self.directory) if name.endswith(".json")
+        )
+
+    def save(self, field):
+        """Write ``field``, replacing any stored field of the same name.
+
+        Both files are written to temporary paths and renamed into place,
+        since loaded fields keep the old ``.npy`` memory-mapped and
+        rewriting it in place would pull the pages out from under them.
+        """
+        values_path, meta_path = self._paths(field.name)
+        _write_atomic(values_path, lambda f: np.save(f, np.asarray(field.values, dtype=np.float32)))
+        _write_atomic(meta_path, lambda f: f.write(json.dumps(field.metadata()).encode()))
+        with self._lock:
+            self._loaded.pop(field.name, None)
+
+    def load(self, name):
+        """Return the named EFField, or None if it does not exist."""
+        with self._lock:
+            if name in self._loaded:
+                return self._loaded[name]
+        values_path, meta_path = self._paths(name)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        field = EFField(values=np.load(values_path, mmap_mode="r"), **meta)
+        with self._lock:
+            self._loaded[name] = field
+        return field
+
+    def find(self, start_time, lons, lats, altitudes_ft, aircraft_type, duration_hours):
+        """Return the first stored field covering the request, or None."""
+        for name in self.names():
+            field = self.load(name)
+            if field is not None and field.covers(
+                    start_time, lons, lats, altitudes_ft, aircraft_type, duration_hours,
+            ):
+                return field
+        return None
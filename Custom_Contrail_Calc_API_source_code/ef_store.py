@@ -0,0 +1,116 @@
+"""
+Cross-request store of per-segment EF values.
+
+Segments between popular airports recur across requests, so CoCiP results
+are memoised per segment: an in-memory LRU in front of a SQLite table on
+local disk that survives restarts and is shared by every worker on a host.
+
+A segment is keyed by its endpoints quantised to EF_STORE_QUANTUM_DEG, its
+flight levels, and everything CoCiP's result depends on besides: the aircraft
+type, the exact departure time, the flight's window length and the met slice
+the EF was computed on (its time window, pressure levels and lon/lat box).
+"""
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+EF_STORE_ENABLED = os.getenv("EF_STORE_ENABLED", "1") == "1"
+EF_STORE_PATH = os.getenv(
+    "EF_STORE_PATH", os.path.expanduser("~/.cache/contrail_api/segment_ef.sqlite")
+)
+EF_STORE_MEMORY_ENTRIES = int(os.getenv("EF_STORE_MEMORY_ENTRIES", "500000"))
+EF_STORE_QUANTUM_DEG = float(os.getenv("EF_STORE_QUANTUM_DEG", "0.001"))
+
+# SQLite caps the number of bound parameters per statement
+_SQL_CHUNK = 500
+
+
+class SegmentEFStore:
+    """In-memory LRU of segment EF values, written through to SQLite."""
+
+    def __init__(self, path=EF_STORE_PATH, max_memory_entries=EF_STORE_MEMORY_ENTRIES,
+                 quantum_deg=EF_STORE_QUANTUM_DEG):
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.quantum_deg = quantum_deg
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._db = None
+
+    def _connection(self):
+        # Opened lazily so importing the API never touches the disk
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS segment_ef (key TEXT PRIMARY KEY, ef REAL NOT NULL)"
+            )
+        return self._db
+
+    @staticmethod
+    def window_key(aircraft_type, start_time, duration_hours, met_start, met_end,
+                   pressure_levels, bbox=None):
+        """Key prefix shared by every segment of one EF evaluation."""
+        levels = ",".join(f"{float(level):g}" for level in pressure_levels)
+        box = "global" if bbox is None else ",".join(f"{float(v):g}" for v in bbox)
+        return (
+            f"{aircraft_type}|{pd.Timestamp(start_time).isoformat()}|{float(duration_hours):g}|"
+            f"{pd.Timestamp(met_start).isoformat()}|{pd.Timestamp(met_end).isoformat()}|"
+            f"{levels}|{box}"
+        )
+
+    def key(self, segment, window_key):
+        (lon_a, lat_a, alt_a), (lon_b, lat_b, alt_b) = segment
+        q = self.quantum_deg
+        return (
+            f"{window_key}|"
+            f"{round(lon_a / q)}|{round(lat_a / q)}|{round(alt_a)}|"
+            f"{round(lon_b / q)}|{round(lat_b / q)}|{round(alt_b)}"
+        )
+
+    def get_many(self, keys):
+        """Return a list with the stored EF for each key, or None where missing."""
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+
+            missing = [key for key in dict.fromkeys(keys) if key not in found]
+            if missing:
+                db = self._connection()
+                for k in range(0, len(missing), _SQL_CHUNK):
+                    chunk = missing[k:k + _SQL_CHUNK]
+                    rows = db.execute(
+                        f"SELECT key, ef FROM segment_ef WHERE key IN ({','.join('?' * len(chunk))})",
+                        chunk,
+                    ).fetchall()
+                    for key, ef in rows:
+                        found[key] = ef
+                        self._remember(key, ef)
+        return [found.get(key) for key in keys]
+
+    def put_many(self, items):
+        """Store ``(key, ef)`` pairs in memory and on disk."""
+        items = list(items)
+        if not items:
+            return
+        with self._lock:
+            for key, ef in items:
+                self._remember(key, ef)
+            db = self._connection()
+            with db:
+                db.executemany(
+                    "INSERT OR REPLACE INTO segment_ef (key, ef) VALUES (?, ?)", items
+                )
+
+    def _remember(self, key, ef):
+        self._memory[key] = ef
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
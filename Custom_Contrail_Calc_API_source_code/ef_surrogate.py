@@ -0,0 +1,165 @@
+"""
+Cheap surrogate EF for shortlisting routes before running CoCiP.
+
+A contrail persists when the exhaust plume reaches water saturation on
+mixing (the Schmidt-Appleman criterion, roughly the air being colder than a
+pressure-dependent threshold) and the ambient air is supersaturated with
+respect to ice. The surrogate checks both at each segment midpoint, from the
+nearest point of the already loaded ERA5 met, and scores a segment as
+SURROGATE_EF_PER_KM times its length when both hold and 0.0 otherwise.
+
+It knows nothing about radiation, so it has no sign and no magnitude beyond
+that constant: use it to rank candidate routes, then run CoCiP on those.
+contrail_possible relaxes both tests by a margin and checks every met grid
+point around a segment, to find segments whose EF is very likely 0.0 so
+CoCiP can be skipped for them. This is a conservative approximation, not a
+guarantee: CoCiP also follows the plume as it advects and sinks.
+"""
+import os
+
+import numpy as np
+from pycontrails.physics import units
+
+from ef_field import epoch_seconds
+from routing import haversine_km
+
+# EF of a persistent contrail per km flown, the order of magnitude CoCiP reports
+SURROGATE_EF_PER_KM = float(os.getenv("SURROGATE_EF_PER_KM", "1e11"))
+
+# Schmidt-Appleman mixing line: water vapour emission index, specific heat of
+# air (J/kg/K), molar mass ratio of water to air, fuel heat (J/kg) and overall
+# propulsion efficiency
+EI_H2O = 1.23
+CP_AIR = 1004.0
+EPSILON = 0.622
+Q_FUEL = 43.2e6
+ETA = 0.3
+
+
+def _nearest(coord, points):
+    """Index of the nearest ``coord`` value to each point; ``coord`` may be in any order."""
+    coord = np.asarray(coord, dtype=float)
+    if len(coord) == 1:
+        return np.zeros(np.shape(points), dtype=np.intp)
+    order = np.argsort(coord)
+    ascending = coord[order]
+    k = np.clip(np.searchsorted(ascending, points), 1, len(ascending) - 1)
+    upper = ascending[k] - points < points - ascending[k - 1]
+    return order[np.where(upper, k, k - 1)]
+
+
+def saturation_pressure_ice(air_temperature):
+    """Saturation vapour pressure over ice in Pa (Murphy and Koop, 2005)."""
+    t = air_temperature
+    return np.exp(9.550426 - 5723.265 / t + 3.53068 * np.log(t) - 0.00728332 * t)
+
+
+def sac_threshold_temperature(air_pressure):
+    """Schmidt-Appleman threshold temperature in K at ``air_pressure`` in Pa.
+
+    Uses Schumann's (1996) fit for liquid saturation on the mixing line,
+    which is the threshold for saturated ambient air.
+    """
+    slope = EI_H2O * CP_AIR * air_pressure / (EPSILON * Q_FUEL * (1.0 - ETA))
+    log_slope = np.log(np.maximum(slope - 0.053, 1e-6))
+    return 273.15 - 46.46 + 9.43 * log_slope + 0.720 * log_slope ** 2
+
+
+def persistent_contrail(air_temperature, specific_humidity, air_pressure,
+                        rhi_threshold=1.0, temperature_margin=0.0):
+    """True where a contrail would form (SAC) and persist (ice supersaturation).
+
+    ``rhi_threshold`` below 1 and a positive ``temperature_margin`` (K above
+    the SAC threshold) widen both tests to allow for met interpolation.
+    """
+    vapour_pressure = specific_humidity * air_pressure / (EPSILON + (1.0 - EPSILON) * specific_humidity)
+    rhi = vapour_pressure / saturation_pressure_ice(air_temperature)
+    sac = air_temperature < sac_threshold_temperature(air_pressure) + temperature_margin
+    return sac & (rhi > rhi_threshold)
+
+
+def _sample(ds, points, time_seconds):
+    """Nearest-point air temperature, specific humidity and pressure (Pa)
+    at ``(lon, lat, alt_ft)`` points and epoch seconds."""
+    level_hpa = units.ft_to_pl(points[:, 2])
+    times = ds["time"].values.astype("datetime64[s]").astype(float)
+    index = (
+        _nearest(ds["longitude"].values, points[:, 0]),
+        _nearest(ds["latitude"].values, points[:, 1]),
+        _nearest(ds["level"].values, level_hpa),
+        _nearest(times, np.full(len(points), time_seconds)),
+    )
+    dims = ("longitude", "latitude", "level", "time")
+    air_temperature = ds["air_temperature"].transpose(*dims).values[index]
+    specific_humidity = ds["specific_humidity"].transpose(*dims).values[index]
+    return air_temperature, specific_humidity, 100.0 * level_hpa
+
+
+def _bracket(coord, points):
+    """Indices of the ``coord`` values either side of each point (clamped at
+    the ends); ``coord`` may be in any order."""
+    coord = np.asarray(coord, dtype=float)
+    if len(coord) == 1:
+        zeros = np.zeros(np.shape(points), dtype=np.intp)
+        return zeros, zeros
+    order = np.argsort(coord)
+    k = np.clip(np.searchsorted(coord[order], points), 1, len(coord) - 1)
+    return order[k - 1], order[k]
+
+
+def _sample_corners(ds, points, time_seconds):
+    """Yield air temperature, specific humidity and pressure (Pa) at each of
+    the 8 longitude/latitude/level grid points around ``(lon, lat, alt_ft)``
+    points, at the met time nearest ``time_seconds``."""
+    level_hpa = units.ft_to_pl(points[:, 2])
+    levels = np.asarray(ds["level"].values, dtype=float)
+    times = ds["time"].values.astype("datetime64[s]").astype(float)
+    time_index = _nearest(times, np.full(len(points), time_seconds))
+    lon_index = _bracket(ds["longitude"].values, points[:, 0])
+    lat_index = _bracket(ds["latitude"].values, points[:, 1])
+    level_index = _bracket(levels, level_hpa)
+    dims = ("longitude", "latitude", "level", "time")
+    air_temperature = ds["air_temperature"].transpose(*dims).values
+    specific_humidity = ds["specific_humidity"].transpose(*dims).values
+    for i in lon_index:
+        for j in lat_index:
+            for k in level_index:
+                index = (i, j, k, time_index)
+                yield air_temperature[index], specific_humidity[index], 100.0 * levels[k]
+
+
+def surrogate_segment_ef(met, start_time, segments, ef_per_km=SURROGATE_EF_PER_KM):
+    """Surrogate EF for ``((lon, lat, alt), (lon, lat, alt))`` segments, in order."""
+    if not segments:
+        return []
+    ends = np.asarray(segments, dtype=float)  # (n, 2, 3)
+    a, b = ends[:, 0], ends[:, 1]
+    mid = 0.5 * (a + b)
+
+    persistent = persistent_contrail(*_sample(met.data, mid, epoch_seconds(start_time)))
+    length_km = haversine_km(a[:, 0], a[:, 1], b[:, 0], b[:, 1])
+    return (ef_per_km * persistent * length_km).tolist()
+
+
+def contrail_possible(met, times, segments, rhi_threshold=0.9, temperature_margin=2.0):
+    """True for each segment where a persistent contrail is possible at any of
+    ``times``, checked with widened tests at every grid point around both
+    endpoints and the midpoint.
+
+    A segment where this is False is treated as having an EF of 0.0 at all
+    of ``times``. That is an approximation: the margins allow for the met
+    interpolation and small changes between ``times``, but not for CoCiP
+    following a plume into supersaturated air elsewhere.
+    """
+    if not segments:
+        return np.zeros(0, dtype=bool)
+    ends = np.asarray(segments, dtype=float)  # (n, 2, 3)
+    a, b = ends[:, 0], ends[:, 1]
+    possible = np.zeros(len(ends), dtype=bool)
+    for points in (a, 0.5 * (a + b), b):
+        for t in times:
+            for sample in _sample_corners(met.data, points, epoch_seconds(t)):
+                possible |= persistent_contrail(
+                    *sample, rhi_threshold=rhi_threshold, temperature_margin=temperature_margin,
+                )
+    return possible
@@ -0,0 +1,97 @@
+"""
+Background jobs for long-running route optimisations.
+
+A JobManager runs submitted work on a small thread pool with a bounded
+queue, and keeps each job's status, live progress dict and final result so
+clients can poll or stream them instead of holding a request open.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobQueueFull(RuntimeError):
+    """Raised when too many jobs are already queued or running."""
+
+
+class Job:
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = "queued"          # queued -> running -> done | failed
+        self.progress = {}              # updated in place by the running work
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed")
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "progress": dict(self.progress),
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobManager:
+    """Runs ``run_fn(payload, progress)`` for submitted payloads in the background.
+
+    At most ``max_workers`` jobs run at once and at most ``max_pending`` may be
+    queued or running; further submissions raise JobQueueFull. The last
+    ``retention`` finished jobs are kept for polling.
+    """
+
+    def __init__(self, run_fn, max_workers=2, max_pending=32, retention=1000):
+        self.run_fn = run_fn
+        self.max_pending = max_pending
+        self.retention = retention
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="route-job")
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._pending = 0
+
+    def submit(self, payload, run_fn=None):
+        """Queue ``payload``; ``run_fn`` overrides the manager's default for this job."""
+        job = Job()
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise JobQueueFull(f"{self._pending} jobs already pending")
+            self._pending += 1
+            self._jobs[job.id] = job
+            self._trim()
+        self._executor.submit(self._run, job, payload, run_fn or self.run_fn)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job, payload, run_fn):
+        job.status = "running"
+        try:
+            job.result = run_fn(payload, job.progress)
+            job.status = "done"
+        except Exception as exc:
+            job.error = getattr(exc, "detail", None) or str(exc) or type(exc).__name__
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                self._pending -= 1
+
+    def _trim(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(len(finished) - self.retention, 0)]:
+            del self._jobs[job_id]
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -1,404 +1,613 @@
-<<<<<<< HEAD
-
-from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional
-import httpx
-import os
+import asyncio
 import json
+import multiprocessing
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import List, Literal, Optional
+import pandas as pd
+import numpy as np
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from pydantic import BaseModel
+from dotenv import load_dotenv
 
-# from dotenv import load_dotenv
-# load_dotenv()
-
-app = FastAPI(title="SkyTrace API")
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:5173", "http://127.0.0.1:5173"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+from pycontrails import Flight, Fleet, MetDataset
+from pycontrails.datalib.ecmwf import ERA5
+from pycontrails.models.cocip import Cocip
+from pycontrails.models.ps_model import PSFlight
+from pycontrails.physics import units
+
+from ef_field import EFField, EFFieldStore, epoch_seconds
+from ef_store import EF_STORE_ENABLED, SegmentEFStore
+from ef_surrogate import contrail_possible, surrogate_segment_ef
+from jobs import JobManager, JobQueueFull
+from met_cache import MET_CACHE_OFFLINE, MetCache, MetCacheMiss, cache_key
+from metrics import (
+    EF_SEGMENTS, EF_STORE_LOOKUPS, HTTP_REQUEST_SECONDS, ROUTE_CACHE_LOOKUPS,
+    SEARCH_EDGES_RELAXED, SEARCH_HEAP_OPERATIONS, SEARCH_NODES_EXPANDED, SURROGATE_RELATIVE_ERROR,
+    StageClock, record_ef_failures,
+)
+from routing import (
+    RouteGrid, corridor_rows, flat_cost_fn, great_circle_heuristic, grid_dijkstra,
+    grid_k_shortest, haversine_km, lazy_flat_cost_fn, path_layer_sums, solve_layered_dag, solve_layered_dag_kbest,
+    solve_layered_dag_sweep,
 )
 
+load_dotenv()
 
+CDS_API_KEY = os.getenv("ECMWF_API_KEY")
+CDS_URL = "https://cds.climate.copernicus.eu/api"
 
-class ChatRequest(BaseModel):
-    system: str
-    messages: list
+cds_api_rc = f"""url: {CDS_URL}
+key: {CDS_API_KEY}
+"""
 
+_cdsapirc_written = False
 
-class LatLon(BaseModel):
-    lat: float
-    lon: float
 
+def write_cdsapirc():
+    """Write ~/.cdsapirc the first time ERA5 actually has to be downloaded."""
+    global _cdsapirc_written
+    if _cdsapirc_written:
+        return
+    with open(os.path.expanduser('~/.cdsapirc'), 'w') as f:
+        f.write(cds_api_rc)
+    _cdsapirc_written = True
 
-class GridConfig(BaseModel):
-    lat_step_deg: float = 0.5
-    lon_step_deg: float = 0.5
-    altitudes_ft: list = [30000, 34000, 38000]
-    max_expansions: int = 8000
+# Number of distinct met time windows kept loaded in memory
+MET_CONTEXT_CACHE_SIZE = int(os.getenv("MET_CONTEXT_CACHE_SIZE", "4"))
 
+# Parallel EF stage: worker processes, edges per worker task, and how worker
+# processes are started. Forking the multi-threaded API process is unsafe.
+EF_MAX_WORKERS = int(os.getenv("EF_MAX_WORKERS", str(os.cpu_count() or 1)))
+EF_BATCH_SIZE = int(os.getenv("EF_BATCH_SIZE", "64"))
+EF_START_METHOD = os.getenv(
+    "EF_START_METHOD",
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn",
+)
 
-class OptimizeRequest(BaseModel):
-    start: LatLon
-    end: LatLon
-    departure_time: str
-    aircraft_type: str = "B738"
-    lambda_value: float = 1.0  
-    grid_config: Optional[GridConfig] = None
+# Number of computed routes kept for reuse across endpoints
+ROUTE_CACHE_SIZE = int(os.getenv("ROUTE_CACHE_SIZE", "128"))
+# Largest number of alternative routes one request may ask for
+K_ROUTES_MAX = int(os.getenv("K_ROUTES_MAX", "20"))
+# Largest surrogate shortlist one request may ask CoCiP to re-cost
+SURROGATE_TOP_K_MAX = int(os.getenv("SURROGATE_TOP_K_MAX", "50"))
+
+# Incremental re-planning: flights remembered, EF snapshots kept per flight,
+# and the widest gap between two snapshots that EF is interpolated across
+REPLAN_CACHE_SIZE = int(os.getenv("REPLAN_CACHE_SIZE", "64"))
+REPLAN_SNAPSHOTS = int(os.getenv("REPLAN_SNAPSHOTS", "4"))
+REPLAN_INTERP_MINUTES = float(os.getenv("REPLAN_INTERP_MINUTES", "60"))
+# Extra hours of met loaded past a flight's window so later delays stay on the same slice
+REPLAN_MET_MARGIN_HOURS = float(os.getenv("REPLAN_MET_MARGIN_HOURS", "1"))
+
+PRESSURE_LEVELS = (300, 250, 225, 200)
+
+# Met slices cover only the route's bounding box, widened by a margin so
+# contrails can drift before leaving the met domain, and snapped outward so
+# nearby routes share a cached slice. MET_SUBSET=0 loads the whole globe.
+MET_SUBSET = os.getenv("MET_SUBSET", "1") == "1"
+MET_BBOX_MARGIN_DEG = float(os.getenv("MET_BBOX_MARGIN_DEG", "10"))
+MET_BBOX_SNAP_DEG = float(os.getenv("MET_BBOX_SNAP_DEG", "5"))
+
+# Pressure levels (hPa) published by ERA5 in the flight-level range
+ERA5_PRESSURE_LEVELS = (
+    1000, 975, 950, 925, 900, 875, 850, 825, 800, 775, 750, 700, 650, 600,
+    550, 500, 450, 400, 350, 300, 250, 225, 200, 175, 150, 125, 100,
+)
 
-    class Config:
-        populate_by_name = True
 
+def pressure_levels_for(altitudes_ft):
+    """ERA5 pressure levels needed to model contrails at the given flight levels.
 
+    Takes every level bracketing the flight levels plus one level of margin
+    above and below, and always includes the default PRESSURE_LEVELS.
+    """
+    pressures = units.ft_to_pl(np.asarray(altitudes_ft, dtype=float))
+    levels = np.array(ERA5_PRESSURE_LEVELS)  # descending pressure, ascending altitude
+    bottom = np.nonzero(levels >= pressures.max())[0]
+    top = np.nonzero(levels <= pressures.min())[0]
+    lo = max((bottom[-1] if bottom.size else 0) - 1, 0)
+    hi = min((top[0] if top.size else len(levels) - 1) + 1, len(levels) - 1)
+    selected = set(levels[lo:hi + 1].tolist()) | set(PRESSURE_LEVELS)
+    return tuple(sorted(selected, reverse=True))
 
-@app.get("/health")
-async def health():
-    return {"status": "ok", "service": "SkyTrace API"}
 
+def met_bbox(lons, lats):
+    """``(lon_min, lon_max, lat_min, lat_max)`` of the met needed around the given points.
 
+    Returns None, meaning the whole globe, when MET_SUBSET is off or the
+    widened box would cross the antimeridian.
+    """
+    if not MET_SUBSET:
+        return None
+    margin, snap = MET_BBOX_MARGIN_DEG, MET_BBOX_SNAP_DEG
+    lon_min = np.floor((np.min(lons) - margin) / snap) * snap
+    lon_max = np.ceil((np.max(lons) + margin) / snap) * snap
+    lat_min = np.floor((np.min(lats) - margin) / snap) * snap
+    lat_max = np.ceil((np.max(lats) + margin) / snap) * snap
+    if lon_min < -180 or lon_max > 180:
+        return None
+    return float(lon_min), float(lon_max), float(max(lat_min, -90)), float(min(lat_max, 90))
+
+
+def union_bbox(bboxes):
+    """Smallest bbox holding all of ``bboxes``; None if any of them is global."""
+    bboxes = list(bboxes)
+    if any(bbox is None for bbox in bboxes):
+        return None
+    lon_mins, lon_maxs, lat_mins, lat_maxs = zip(*bboxes)
+    return min(lon_mins), max(lon_maxs), min(lat_mins), max(lat_maxs)
+
+
+def bbox_covers(outer, inner):
+    """True if met loaded for bbox ``outer`` contains bbox ``inner``."""
+    if outer is None:
+        return True
+    if inner is None:
+        return False
+    return (
+        outer[0] <= inner[0] and inner[1] <= outer[1]
+        and outer[2] <= inner[2] and inner[3] <= outer[3]
+    )
 
-ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY", "YOUR_KEY_HERE")
+met_cache = MetCache()
 
 
-@app.post("/api/chat")
-async def chat_proxy(request: ChatRequest):
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.post(
-            "https://api.anthropic.com/v1/messages",
-            headers={
-                "Content-Type": "application/json",
-                "x-api-key": ANTHROPIC_API_KEY,
-                "anthropic-version": "2023-06-01",
-            },
-            json={
-                "model": "claude-sonnet-4-20250514",
-                "max_tokens": 500,
-                "system": request.system,
-                "messages": request.messages,
-            },
-        )
-        data = response.json()
-
-    text = data.get("content", [{}])[0].get("text", "Sorry, no response.")
-    return {"response": text}
-
-
-@app.post("/api/extract-flight")
-async def extract_flight(request: ChatRequest):
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.post(
-            "https://api.anthropic.com/v1/messages",
-            headers={
-                "Content-Type": "application/json",
-                "x-api-key": ANTHROPIC_API_KEY,
-                "anthropic-version": "2023-06-01",
-            },
-            json={
-                "model": "claude-sonnet-4-20250514",
-                "max_tokens": 300,
-                "system": request.system,
-                "messages": request.messages,
-            },
-        )
-        data = response.json()
+def load_met_slice(start_time, end_time, variables, pressure_levels=None, bbox=None):
+    """Return an in-memory MetDataset for one ERA5 slice.
 
-    text = data.get("content", [{}])[0].get("text", "{}")
-    return {"response": text}
+    Served from the on-disk met cache when present; otherwise downloaded from
+    CDS and written through to the cache. In offline mode a miss raises
+    MetCacheMiss instead of touching the network. With a ``bbox`` only that
+    lon/lat box is read out of the lazily opened ERA5 files, and only it is
+    held in memory and cached.
+    """
+    key = cache_key(start_time, end_time, pressure_levels, variables, bbox)
+    ds = met_cache.get(key)
+    if ds is not None:
+        return MetDataset(ds)
+
+    if MET_CACHE_OFFLINE:
+        raise MetCacheMiss(f"Met slice {key} not found in {met_cache.directory}")
+
+    write_cdsapirc()
+    era5_kwargs = {}
+    if pressure_levels is not None:
+        era5_kwargs["pressure_levels"] = list(pressure_levels)
+    era5 = ERA5(
+        time=(start_time, end_time),
+        variables=variables,
+        **era5_kwargs,
+    )
+    met = era5.open_metdataset()
+    if bbox is not None:
+        lon_min, lon_max, lat_min, lat_max = bbox
+        met = MetDataset(met.data.sel(
+            longitude=slice(lon_min, lon_max), latitude=slice(lat_min, lat_max),
+        ))
+    met.data.load()
+    met_cache.put(key, met.data)
+    return met
+
+
+class MetContext:
+    """ERA5 met and rad datasets for one time window and lon/lat box.
+
+    Opened once and shared by every EF evaluation that covers the same
+    window, instead of re-opening ERA5 for each edge. Slices come from the
+    on-disk met cache when available. ``bbox`` None means the whole globe.
+    """
 
+    def __init__(self, start_time, end_time, pressure_levels=PRESSURE_LEVELS, bbox=None):
+        self.start_time = start_time
+        self.end_time = end_time
+        self.pressure_levels = tuple(pressure_levels)
+        self.bbox = bbox
 
+        self.met = load_met_slice(
+            start_time, end_time, Cocip.met_variables, self.pressure_levels, bbox
+        )
+        self.rad = load_met_slice(start_time, end_time, Cocip.rad_variables, bbox=bbox)
 
-OPTIMIZER_URL = os.getenv(
-    "OPTIMIZER_URL",
-    "https://testfastapi-production-325b.up.railway.app/optimum_ef_route"
-)
+    def __repr__(self):
+        return (
+            f"MetContext({self.start_time} -> {self.end_time}, "
+            f"pressure_levels={self.pressure_levels}, bbox={self.bbox})"
+        )
 
 
-@app.post("/api/optimize")
-async def optimize_route(request: OptimizeRequest):
-    optimizer_payload = {
-        "grid_density": 6,
-        "start_long": request.start.lon,
-        "start_lat": request.start.lat,
-        "end_long": request.end.lon,
-        "end_lat": request.end.lat,
-        "start_time": request.departure_time,
-        "duration_hours": 2, 
-        "fuel_cost_per_km": 0.15,
-        "lambda_value": request.lambda_value,
-    }
+@lru_cache(maxsize=MET_CONTEXT_CACHE_SIZE)
+def get_met_context(start_time, end_time, pressure_levels=PRESSURE_LEVELS, bbox=None):
+    """Return the shared MetContext for a (start_time, end_time, pressure_levels, bbox) key."""
+    return MetContext(start_time, end_time, tuple(pressure_levels), bbox)
 
-    try:
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(
-                OPTIMIZER_URL,
-                json=optimizer_payload,
-            )
-            data = response.json()
 
-        # verification_response = await verify_route(data)
-        # return verification_response
+def compute_ef(
+        start_time, duration_hours,
+        longs, lats,
+        altitude_ft, aircraft_type,
+        met_context=None,
+):
+    end_time = start_time + timedelta(hours=duration_hours)
 
-        return data
+    flight_data = pd.DataFrame({
+        "longitude": np.array(longs),
+        "latitude": np.array(lats),
+        "altitude_ft": np.broadcast_to(np.asarray(altitude_ft, dtype=float), (len(longs),)).copy(),
+        "time": np.array([start_time for _ in range(len(longs))])
+    })
 
-    except httpx.TimeoutException:
-        return {"error": "Optimizer timed out. Try reducing grid density."}
-    except Exception as e:
-        return {"error": str(e)}
+    flight = Flight(
+        data=flight_data,
+        aircraft_type=aircraft_type,
+        flight_id="test_flight"
+    )
 
+    if met_context is None:
+        met_context = get_met_context(start_time, end_time)
 
+    ps_model = PSFlight()
+    cocip = Cocip(
+        met=met_context.met,
+        rad=met_context.rad,
+        aircraft_performance=ps_model
+    )
 
-VERIFY_URL = os.getenv("VERIFY_URL", "http://localhost:8001/api/verifyRoute")
+    output = cocip.eval(flight)
 
+    result_df = output.dataframe
+    return result_df['ef'].tolist()
 
-@app.post("/api/verify")
-async def verify_route(route_payload: dict):
-    try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(VERIFY_URL, json=route_payload)
-            return response.json()
-    except Exception:
-        return {
-            "status": "unverified",
-            "verified_on_chain": False,
-            "route_payload": route_payload,
-        }
+def compute_ef_batch(
+        start_time, duration_hours,
+        segments,
+        aircraft_type,
+        met_context=None,
+        pressure_levels=PRESSURE_LEVELS,
+        failures=None,
+):
+    """Compute summed EF for many two-waypoint segments in one CoCiP run.
 
+    Every segment ``((lon_a, lat_a, alt_a), (lon_b, lat_b, alt_b))`` becomes
+    its own flight in a single ``Fleet``, so CoCiP and the aircraft
+    performance model are set up once for the whole grid. The ``ef`` column
+    is then split back per segment with a groupby. If the batched run fails,
+    each segment is evaluated on its own with ``compute_ef``, falling back to
+    0.0 as before. If ``failures`` is a dict, its ``batch`` and ``segment``
+    counts are advanced for each fallback.
 
+    Returns a list of EF values in the same order as ``segments``.
+    """
+    if not segments:
+        return []
 
-if __name__ == "__main__":
-    import uvicorn
-    print("🛫 Starting SkyTrace API on http://localhost:8000")
-    print("📖 Docs: http://localhost:8000/docs")
-    uvicorn.run(app, host="0.0.0.0", port=8000, reload=True)
-=======
-import os
-from datetime import datetime, timedelta
-import pandas as pd
-import numpy as np
-from fastapi import FastAPI
-from pydantic import BaseModel
-from dotenv import load_dotenv
+    end_time = start_time + timedelta(hours=duration_hours)
+    if met_context is None:
+        met_context = get_met_context(start_time, end_time, pressure_levels)
 
-from pycontrails import Flight
-from pycontrails.datalib.ecmwf import ERA5
-from pycontrails.models.cocip import Cocip
-from pycontrails.models.ps_model import PSFlight
+    flight_ids = [f"edge_{k}" for k in range(len(segments))]
+    try:
+        flights = []
+        for flight_id, ((lon_a, lat_a, alt_a), (lon_b, lat_b, alt_b)) in zip(flight_ids, segments):
+            flight_data = pd.DataFrame({
+                "longitude": np.array([lon_a, lon_b]),
+                "latitude": np.array([lat_a, lat_b]),
+                "altitude_ft": np.array([alt_a, alt_b]),
+                "time": np.array([start_time, start_time]),
+            })
+            flights.append(Flight(
+                data=flight_data,
+                aircraft_type=aircraft_type,
+                flight_id=flight_id,
+            ))
+        fleet = Fleet.from_seq(flights)
+
+        cocip = Cocip(
+            met=met_context.met,
+            rad=met_context.rad,
+            aircraft_performance=PSFlight(),
+        )
+        output = cocip.eval(fleet)
 
-load_dotenv()
+        ef_by_flight = (
+            output.dataframe.groupby("flight_id")["ef"].sum()
+            .reindex(flight_ids, fill_value=0.0)
+        )
+        return ef_by_flight.fillna(0.0).tolist()
+    except Exception:
+        if failures is not None:
+            failures["batch"] = failures.get("batch", 0) + 1
 
-CDS_API_KEY = os.getenv("ECMWF_API_KEY")
-CDS_URL = "https://cds.climate.copernicus.eu/api"
+    ef_values = []
+    for (lon_a, lat_a, alt_a), (lon_b, lat_b, alt_b) in segments:
+        try:
+            segment_ef = compute_ef(
+                start_time=start_time,
+                duration_hours=duration_hours,
+                longs=[lon_a, lon_b],
+                lats=[lat_a, lat_b],
+                altitude_ft=[alt_a, alt_b],
+                aircraft_type=aircraft_type,
+                met_context=met_context,
+            )
+            ef_values.append(sum(segment_ef) if segment_ef else 0.0)
+        except Exception:
+            if failures is not None:
+                failures["segment"] = failures.get("segment", 0) + 1
+            ef_values.append(0.0)
+    return ef_values
 
-cds_api_rc = f"""url: {CDS_URL}
-key: {CDS_API_KEY}
-"""
+_ef_executor = None
+_ef_executor_lock = threading.Lock()
 
-with open(os.path.expanduser('~/.cdsapirc'), 'w') as f:
-    f.write(cds_api_rc)
-
-class MinPriorityQueue:
-    def __init__(self):
-        self._heap = []                # list of [value, coord]
-        self._index_map = {}           # coord -> index in heap
-        self._value_map = {}           # coord -> current value
-
-    def _swap(self, i, j):
-        self._heap[i], self._heap[j] = self._heap[j], self._heap[i]
-        self._index_map[self._heap[i][1]] = i
-        self._index_map[self._heap[j][1]] = j
-
-    def _sift_up(self, i):
-        while i > 0:
-            parent = (i - 1) // 2
-            if self._heap[i][0] < self._heap[parent][0]:
-                self._swap(i, parent)
-                i = parent
-            else:
-                break
-
-    def _sift_down(self, i):
-        n = len(self._heap)
-        while True:
-            smallest = i
-            left = 2 * i + 1
-            right = 2 * i + 2
-            if left < n and self._heap[left][0] < self._heap[smallest][0]:
-                smallest = left
-            if right < n and self._heap[right][0] < self._heap[smallest][0]:
-                smallest = right
-            if smallest != i:
-                self._swap(i, smallest)
-                i = smallest
-            else:
-                break
-
-    def enqueue(self, coord, value):
-        """Insert a coordinate with an associated value."""
-        if coord in self._index_map:
-            raise ValueError(f"{coord} already in queue. Use decrease_value() instead.")
-        entry = [value, coord]
-        self._heap.append(entry)
-        idx = len(self._heap) - 1
-        self._index_map[coord] = idx
-        self._value_map[coord] = value
-        self._sift_up(idx)
-
-    def dequeue_min(self):
-        """Remove and return (coord, value) with the smallest value."""
-        if not self._heap:
-            raise IndexError("dequeue from empty queue")
-        self._swap(0, len(self._heap) - 1)
-        value, coord = self._heap.pop()
-        del self._index_map[coord]
-        del self._value_map[coord]
-        if self._heap:
-            self._sift_down(0)
-        return coord, value
-
-    def decrease_value(self, coord, new_value):
-        """Decrease the value associated with a coordinate.
-        
-        Raises ValueError if new_value is not strictly less than current value.
-        """
-        if coord not in self._index_map:
-            raise KeyError(f"{coord} not found in queue")
-        old_value = self._value_map[coord]
-        if new_value >= old_value:
-            raise ValueError(f"New value {new_value} must be less than current value {old_value}")
-        idx = self._index_map[coord]
-        self._heap[idx][0] = new_value
-        self._value_map[coord] = new_value
-        self._sift_up(idx)
-
-    def peek_min(self):
-        """Return (coord, value) with the smallest value without removing it."""
-        if not self._heap:
-            raise IndexError("peek from empty queue")
-        return self._heap[0][1], self._heap[0][0]
-
-    def get_value(self, coord):
-        """Return the current value associated with a coordinate."""
-        return self._value_map[coord]
-
-    def __contains__(self, coord):
-        return coord in self._index_map
-
-    def __len__(self):
-        return len(self._heap)
-
-    def __bool__(self):
-        return bool(self._heap)
 
-    def __repr__(self):
-        items = [(entry[1], entry[0]) for entry in self._heap]
-        return f"MinPriorityQueue({items})"
+def start_ef_executor():
+    """Create the process-wide EF worker pool, started with EF_START_METHOD.
 
-def build_adjacency_list(edges):
-    adj = {}
-    for a, b, w in edges:
-        adj.setdefault(a, []).append((b, w))
-        adj.setdefault(b, []).append((a, w))
-    return adj
+    Called from the app's lifespan handler, before any request or job
+    thread exists.
+    """
+    global _ef_executor
+    with _ef_executor_lock:
+        if _ef_executor is None:
+            _ef_executor = ProcessPoolExecutor(
+                max_workers=EF_MAX_WORKERS,
+                mp_context=multiprocessing.get_context(EF_START_METHOD),
+            )
+        return _ef_executor
+
+
+def get_ef_executor():
+    """Return the EF worker pool, starting it here when running outside the app."""
+    return _ef_executor or start_ef_executor()
+
+
+def shutdown_ef_executor():
+    global _ef_executor
+    with _ef_executor_lock:
+        if _ef_executor is not None:
+            _ef_executor.shutdown(cancel_futures=True)
+            _ef_executor = None
+
+
+def _ef_worker_batch(start_time, duration_hours, segments, aircraft_type, pressure_levels, met_window):
+    # Runs in a pool worker, which shares no memory with the API process:
+    # it opens the (start, end, bbox) ``met_window`` itself, from the met
+    # cache the parent filled. get_met_context is cached per process, so
+    # each worker loads a window once and keeps it for later batches.
+    # Returns (ef_values, failures) so the parent process can record metrics.
+    window_start, window_end, bbox = met_window
+    met_context = get_met_context(window_start, window_end, pressure_levels, bbox)
+    failures = {}
+    ef_values = compute_ef_batch(
+        start_time=start_time,
+        duration_hours=duration_hours,
+        segments=segments,
+        aircraft_type=aircraft_type,
+        met_context=met_context,
+        pressure_levels=pressure_levels,
+        failures=failures,
+    )
+    return ef_values, failures
 
 
-def dijkstra(edges, start, end, cost_fn):
-    adj = build_adjacency_list(edges)
+# Segment EF values kept across requests, or None when EF_STORE_ENABLED is off
+segment_ef_store = SegmentEFStore() if EF_STORE_ENABLED else None
 
-    if start not in adj:
-        return float('inf'), []
 
-    pq = MinPriorityQueue()
-    dist = {start: 0}
-    prev = {start: None}
+def compute_ef_parallel(
+        start_time, duration_hours,
+        segments,
+        aircraft_type,
+        met_context=None,
+        pressure_levels=PRESSURE_LEVELS,
+        batch_size=EF_BATCH_SIZE,
+        progress=None,
+):
+    """Compute summed EF per segment, fanning batches out over the EF worker pool.
 
-    pq.enqueue(start, 0)
+    Segments already in ``segment_ef_store`` are read from it and only the
+    rest go to CoCiP; their results are written back unless their batch had
+    segments fall back to 0.0. Small grids, or ``EF_MAX_WORKERS <= 1``, run
+    in-process with compute_ef_batch. A batch whose worker fails falls back
+    to 0.0 for each of its segments, as a failing edge did before. If
+    ``progress`` is a dict, its ``edges_evaluated`` count is advanced as
+    batches finish and its ``ef_cocip`` count by the segments sent to CoCiP.
 
-    while pq:
-        current, current_dist = pq.dequeue_min()
+    Returns a list of EF values in the same order as ``segments``.
+    """
+    if segment_ef_store is None:
+        ef_values, _ok = _compute_ef_cocip(
+            start_time, duration_hours, segments, aircraft_type,
+            met_context, pressure_levels, batch_size, progress,
+        )
+        return ef_values
+
+    if met_context is None:
+        met_start, met_end, bbox = start_time, start_time + timedelta(hours=duration_hours), None
+    else:
+        met_start, met_end, bbox = met_context.start_time, met_context.end_time, met_context.bbox
+        pressure_levels = met_context.pressure_levels
+    window_key = segment_ef_store.window_key(
+        aircraft_type, start_time, duration_hours, met_start, met_end, pressure_levels, bbox,
+    )
+    keys = [segment_ef_store.key(segment, window_key) for segment in segments]
+    ef_values = segment_ef_store.get_many(keys)
+    missing = [k for k, value in enumerate(ef_values) if value is None]
+    EF_STORE_LOOKUPS.labels("hit").inc(len(segments) - len(missing))
+    EF_STORE_LOOKUPS.labels("miss").inc(len(missing))
+    EF_SEGMENTS.labels("store").inc(len(segments) - len(missing))
+    _advance_progress(progress, len(segments) - len(missing))
+    if not missing:
+        return ef_values
+
+    computed, ok = _compute_ef_cocip(
+        start_time, duration_hours, [segments[k] for k in missing], aircraft_type,
+        met_context, pressure_levels, batch_size, progress,
+    )
+    for k, value in zip(missing, computed):
+        ef_values[k] = value
+    segment_ef_store.put_many(
+        (keys[k], value) for k, value, stored in zip(missing, computed, ok) if stored
+    )
+    return ef_values
+
+
+def _compute_ef_cocip(start_time, duration_hours, segments, aircraft_type,
+                      met_context, pressure_levels, batch_size, progress):
+    """Run CoCiP for ``segments``; returns the EF values and, per segment,
+    whether the value is a real result rather than a 0.0 fallback."""
+    EF_SEGMENTS.labels("cocip").inc(len(segments))
+    _count_cocip(progress, len(segments))
+    if EF_MAX_WORKERS <= 1 or len(segments) <= batch_size:
+        failures = {}
+        ef_values = compute_ef_batch(
+            start_time=start_time,
+            duration_hours=duration_hours,
+            segments=segments,
+            aircraft_type=aircraft_type,
+            met_context=met_context,
+            pressure_levels=pressure_levels,
+            failures=failures,
+        )
+        record_ef_failures(failures)
+        _advance_progress(progress, len(segments))
+        return ef_values, [not failures.get("segment")] * len(segments)
+
+    # Load (and disk-cache) the window in this process first so workers
+    # never race each other to download it
+    if met_context is None:
+        met_context = get_met_context(
+            start_time, start_time + timedelta(hours=duration_hours), pressure_levels
+        )
+    pressure_levels = met_context.pressure_levels
+    met_window = (met_context.start_time, met_context.end_time, met_context.bbox)
+
+    executor = get_ef_executor()
+    batches = [segments[k:k + batch_size] for k in range(0, len(segments), batch_size)]
+    futures = [
+        executor.submit(
+            _ef_worker_batch,
+            start_time, duration_hours, batch, aircraft_type, pressure_levels, met_window,
+        )
+        for batch in batches
+    ]
 
-        # Early exit
-        if current == end:
-            break
+    ef_values, ok = [], []
+    for batch, future in zip(batches, futures):
+        try:
+            batch_values, failures = future.result()
+            ef_values.extend(batch_values)
+            ok.extend([not failures.get("segment")] * len(batch))
+            record_ef_failures(failures)
+        except Exception:
+            record_ef_failures({"worker": len(batch)})
+            ef_values.extend([0.0] * len(batch))
+            ok.extend([False] * len(batch))
+        _advance_progress(progress, len(batch))
+    return ef_values, ok
 
-        # Skip stale entries
-        if current_dist > dist.get(current, float('inf')):
-            continue
 
-        for neighbor, _edge_weight in adj.get(current, []):
-            # Use custom cost function instead of (or in addition to) edge weight
-            edge_cost = cost_fn(current, neighbor)
-            new_dist = current_dist + edge_cost
+def _advance_progress(progress, num_edges):
+    if progress is not None:
+        progress["edges_evaluated"] = progress.get("edges_evaluated", 0) + num_edges
 
-            if new_dist < dist.get(neighbor, float('inf')):
-                dist[neighbor] = new_dist
-                prev[neighbor] = current
 
-                if neighbor in pq:
-                    pq.decrease_value(neighbor, new_dist)
-                else:
-                    pq.enqueue(neighbor, new_dist)
+def _count_cocip(progress, num_segments):
+    if progress is not None:
+        progress["ef_cocip"] = progress.get("ef_cocip", 0) + num_segments
 
-    # Reconstruct path
-    if end not in dist:
-        return float('inf'), []
 
-    path = []
-    node = end
-    while node is not None:
-        path.append(node)
-        node = prev[node]
-    path.reverse()
+class LazyEdgeEF:
+    """Grid edge EF computed the first time the search asks for it.
 
-    return dist[end], path
+    Results are memoised in an (n_cols - 1, n_states, n_states) array, with
+    NaN marking edges not evaluated yet. With ``prefetch``, the first request
+    for an edge leaving node (i, s) evaluates all of that node's outgoing
+    edges in one batched CoCiP run, because the search relaxes them together.
+    """
 
-def compute_ef(
-        start_time, duration_hours,
-        longs, lats,
-        altitude_ft, aircraft_type
-):
-    end_time = start_time + timedelta(hours=duration_hours)
+    def __init__(
+            self, grid,
+            start_time, duration_hours,
+            aircraft_type,
+            met_context,
+            prefetch=True,
+            progress=None,
+    ):
+        self.grid = grid
+        self.start_time = start_time
+        self.duration_hours = duration_hours
+        self.aircraft_type = aircraft_type
+        self.met_context = met_context
+        self.prefetch = prefetch
+        self.progress = progress
+        self.values = np.full((grid.n_cols - 1, grid.n_states, grid.n_states), np.nan)
+        self.evaluated = 0
+
+    def __call__(self, i, s_from, s_to):
+        value = self.values[i, s_from, s_to]
+        if value != value:  # NaN: not evaluated yet
+            if self.prefetch:
+                targets = np.nonzero(self.grid.transitions[s_from])[0]
+                targets = targets[np.isnan(self.values[i, s_from, targets])]
+            else:
+                targets = np.array([s_to])
+
+            ef_values = compute_ef_parallel(
+                start_time=self.start_time,
+                duration_hours=self.duration_hours,
+                segments=[self.grid.segment(i, s_from, s) for s in targets.tolist()],
+                aircraft_type=self.aircraft_type,
+                met_context=self.met_context,
+                progress=self.progress,
+            )
+            self.values[i, s_from, targets] = ef_values
+            self.evaluated += len(targets)
+            value = self.values[i, s_from, s_to]
+        return float(value)
 
-    flight_data = pd.DataFrame({
-        "longitude": np.array(longs),
-        "latitude": np.array(lats),
-        "altitude_ft": np.array([altitude_ft for _ in range(len(longs))]),
-        "time": np.array([start_time for _ in range(len(longs))])
-    })
 
-    flight = Flight(
-        data=flight_data,
-        aircraft_type=aircraft_type,
-        flight_id="test_flight"
-    )
+@asynccontextmanager
+async def lifespan(app):
+    if EF_MAX_WORKERS > 1:
+        start_ef_executor()
+    yield
+    job_manager.shutdown()
+    shutdown_ef_executor()
 
-    era5 = ERA5(
-        time=(start_time, end_time),
-        variables=Cocip.met_variables,
-        pressure_levels = [300, 250, 225, 200],
-    )
-    met = era5.open_metdataset()
 
-    era5_rad = ERA5(
-        time=(start_time, end_time),
-        variables=Cocip.rad_variables,
-    )
-    rad = era5_rad.open_metdataset()
+app = FastAPI(lifespan=lifespan)
 
-    ps_model = PSFlight()
-    cocip = Cocip(
-        met=met,
-        rad=rad,
-        aircraft_performance=ps_model
-    )
 
-    output = cocip.eval(flight)
+@app.middleware("http")
+async def observe_request_latency(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        HTTP_REQUEST_SECONDS.labels(
+            request.method, getattr(route, "path", "unmatched"), str(status)
+        ).observe(time.perf_counter() - start)
 
-    result_df = output.dataframe
-    return result_df['ef'].tolist()
 
-app = FastAPI()
+@app.get("/metrics")
+def metrics():
+    """Prometheus metrics: per-stage timings, EF counts and failures, search counters."""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 class FlightData(BaseModel):
     grid_density: int
@@ -410,86 +619,1206 @@ class FlightData(BaseModel):
     duration_hours: float
     fuel_cost_per_km: float
     lambda_value: float
+    solver: Literal["dijkstra", "astar", "dag"] = "dijkstra"
+    aircraft_type: str = "A320"
+    altitudes_ft: List[float] = [35000]
+    lat_step_deg: Optional[float] = None  # overrides grid_density for lateral rows
+    lon_step_deg: Optional[float] = None  # overrides grid_density for columns
+    max_expansions: Optional[int] = None  # dijkstra/astar search budget
+    ef_lower_bound: Optional[float] = None  # per-segment EF floor for the astar heuristic
+    ef_mode: Literal["eager", "lazy", "surrogate"] = "eager"
+    ef_prefetch: bool = True  # lazy mode: evaluate all of a node's outgoing edges together
+    max_lateral_change: Optional[int] = None  # max lateral rows between consecutive columns
+    flight_id: Optional[str] = None  # eager mode: re-plan incrementally when start_time shifts
+    ef_field: Optional[str] = None  # eager mode: precomputed EF field name, or "auto"
+    refine_levels: int = 0  # eager mode: coarse passes before the full-resolution corridor
+    refine_corridor: int = 2  # refined passes: rows kept either side of the previous route
+    surrogate_top_k: int = 5  # surrogate mode: shortlisted routes re-costed with CoCiP
+    k_routes: int = 1  # return this many cheapest distinct routes in "routes"
+
+
+class ParetoRequest(FlightData):
+    lambda_value: float = 0.0  # unused; the sweep below sets lambda per route
+    lambda_values: Optional[List[float]] = None
+    lambda_min: Optional[float] = None  # used with lambda_max when lambda_values is not given
+    lambda_max: Optional[float] = None
+    lambda_steps: int = 11
+    lambda_spacing: Literal["linear", "log"] = "linear"
+
+
+class EFFieldRequest(BaseModel):
+    name: str
+    lon_min: float
+    lon_max: float
+    lat_min: float
+    lat_max: float
+    lon_step_deg: float = 0.5
+    lat_step_deg: float = 0.5
+    altitudes_ft: List[float] = [35000]
+    start_time: datetime
+    end_time: Optional[datetime] = None  # defaults to start_time: a single time slice
+    time_step_hours: float = 1.0
+    duration_hours: float
+    aircraft_type: str = "A320"
 
-@app.post("/optimum_ef_route")
-def main(dat: FlightData):
-    # 1. Build a grid of waypoints between start and end
-    n = dat.grid_density
-    lons = np.linspace(dat.start_long, dat.end_long, n)
-    lats = np.linspace(dat.start_lat, dat.end_lat, n)
-
-    # Create a 2D grid of (lon, lat) nodes
-    # We allow lateral deviation: for each longitude step, we have multiple latitude options
-    lat_spread = abs(dat.end_lat - dat.start_lat) * 0.5  # allow deviation
-    grid = {}  # (i, j) -> (lon, lat)
-    coords_list = []
-
-    for i in range(n):
-        center_lat = lats[i]
-        lat_options = np.linspace(center_lat - lat_spread, center_lat + lat_spread, n)
-        for j in range(n):
-            grid[(i, j)] = (lons[i], lat_options[j])
-            coords_list.append((i, j))
-
-    # 2. Build edges: connect each node in column i to every node in column i+1
-    edges = []
-    for i in range(n - 1):
-        for j1 in range(n):
-            for j2 in range(n):
-                edges.append(((i, j1), (i + 1, j2), 1.0))  # weight unused, cost_fn handles it
-
-    # 3. Precompute EF for every edge using pycontrails
-    #    For each edge, compute contrail EF along that segment
-    altitude_ft = 35000
-    aircraft_type = "A320"
-
-    ef_cache = {}
-    for (a, b, _) in edges:
-        lon_a, lat_a = grid[a]
-        lon_b, lat_b = grid[b]
-        try:
-            ef_values = compute_ef(
+
+def build_route_grid(dat):
+    return RouteGrid.between(
+        dat.start_long, dat.start_lat, dat.end_long, dat.end_lat,
+        grid_density=dat.grid_density,
+        altitudes_ft=dat.altitudes_ft,
+        lat_step_deg=dat.lat_step_deg,
+        lon_step_deg=dat.lon_step_deg,
+        max_lateral_change=dat.max_lateral_change,
+    )
+
+
+ef_field_store = EFFieldStore()
+
+
+def resolve_ef_field(dat, grid):
+    """The precomputed EF field a request asked for, or None to run CoCiP.
+
+    ``ef_field="auto"`` picks any stored field covering the grid and falls
+    back to CoCiP if there is none; a named field that is missing or does
+    not cover the grid is a 422.
+    """
+    if dat.ef_field is None:
+        return None
+    coverage = dict(
+        start_time=dat.start_time,
+        lons=grid.col_lons,
+        lats=grid.col_lats,
+        altitudes_ft=grid.altitudes_ft,
+        aircraft_type=dat.aircraft_type,
+        duration_hours=dat.duration_hours,
+    )
+    if dat.ef_field == "auto":
+        return ef_field_store.find(**coverage)
+
+    field = ef_field_store.load(dat.ef_field)
+    if field is None or not field.covers(**coverage):
+        raise HTTPException(
+            status_code=422,
+            detail=f"EF field {dat.ef_field!r} does not exist or does not cover this request.",
+        )
+    return field
+
+
+def build_ef_field(spec, progress=None):
+    """Run CoCiP over a region's lattice and store the result as an EF field.
+
+    Each lattice node is evaluated as a segment one ``lon_step_deg`` long,
+    centred on the node and flown eastwards, and its EF is divided by the
+    segment length to give EF per km.
+    """
+    if progress is None:
+        progress = {}
+
+    lons = np.arange(spec.lon_min, spec.lon_max + spec.lon_step_deg / 2, spec.lon_step_deg)
+    lats = np.arange(spec.lat_min, spec.lat_max + spec.lat_step_deg / 2, spec.lat_step_deg)
+    altitudes_ft = np.unique(np.asarray(spec.altitudes_ft, dtype=float))
+    end_time = spec.end_time or spec.start_time
+    times = []
+    t = spec.start_time
+    while t <= end_time:
+        times.append(t)
+        t += timedelta(hours=spec.time_step_hours)
+
+    alt_grid, lat_grid, lon_grid = np.meshgrid(altitudes_ft, lats, lons, indexing="ij")
+    half = spec.lon_step_deg / 2
+    segments = list(zip(
+        zip((lon_grid - half).ravel().tolist(), lat_grid.ravel().tolist(), alt_grid.ravel().tolist()),
+        zip((lon_grid + half).ravel().tolist(), lat_grid.ravel().tolist(), alt_grid.ravel().tolist()),
+    ))
+    length_km = haversine_km(lon_grid - half, lat_grid, lon_grid + half, lat_grid)
+    pressure_levels = pressure_levels_for(altitudes_ft)
+    bbox = met_bbox([spec.lon_min, spec.lon_max], [spec.lat_min, spec.lat_max])
+
+    progress.update(stage="ef", edges_total=len(segments) * len(times), edges_evaluated=0)
+    values = np.empty((len(times), *alt_grid.shape))
+    for k, t in enumerate(times):
+        met_context = get_met_context(
+            t, t + timedelta(hours=spec.duration_hours), pressure_levels, bbox
+        )
+        ef_values = compute_ef_parallel(
+            start_time=t,
+            duration_hours=spec.duration_hours,
+            segments=segments,
+            aircraft_type=spec.aircraft_type,
+            met_context=met_context,
+            progress=progress,
+        )
+        values[k] = np.reshape(ef_values, alt_grid.shape) / length_km
+
+    field = EFField(
+        name=spec.name,
+        times=[epoch_seconds(t) for t in times],
+        altitudes_ft=altitudes_ft,
+        lats=lats,
+        lons=lons,
+        values=values,
+        aircraft_type=spec.aircraft_type,
+        duration_hours=spec.duration_hours,
+    )
+    ef_field_store.save(field)
+    progress["stage"] = "done"
+    return field.metadata()
+
+
+def met_window(dat, grid=None):
+    """``(start_time, end_time, pressure_levels, bbox)`` of the met slice a request needs."""
+    if grid is None:
+        grid = build_route_grid(dat)
+    return (
+        dat.start_time,
+        dat.start_time + timedelta(hours=dat.duration_hours),
+        pressure_levels_for(grid.altitudes_ft),
+        met_bbox(grid.col_lons, grid.col_lats),
+    )
+
+
+def uses_lazy_ef(dat):
+    return dat.ef_mode == "lazy" and dat.solver != "dag"
+
+
+# ``routes`` holds the k_routes cheapest routes as dicts with total_cost,
+# fuel_cost, ef and path, or None when only the best route was asked for
+RouteResult = namedtuple(
+    "RouteResult", ["total_cost", "path", "grid", "stats", "routes"], defaults=(None,)
+)
+
+
+def _era5_hours(start_time, end_time):
+    # ERA5 is hourly and slices are requested out to whole hours
+    return pd.Timestamp(start_time).floor("h"), pd.Timestamp(end_time).ceil("h")
+
+
+class ReplanState:
+    """What one flight_id's last plans left behind: met slice, EF snapshots and route."""
+
+    def __init__(self, geometry, met_context):
+        self.geometry = geometry
+        self.met_context = met_context
+        self.snapshots = OrderedDict()  # start_time -> EF per edge, oldest first
+        self.path = None
+
+
+class ReplanStore:
+    """Per-flight state for incremental re-planning after a departure shift.
+
+    A request with a ``flight_id`` whose grid, aircraft and duration match the
+    stored state gets its EF from the cheapest source that is still exact
+    enough:
+    - "reused": a snapshot at the same start_time;
+    - "interpolated": linear in time between two snapshots at most
+      REPLAN_INTERP_MINUTES apart, with no CoCiP run;
+    - "recomputed": the nearest snapshot, with CoCiP rerun on the stored met
+      slice (so no met is loaded) only for edges whose EF is likely to
+      differ: those with a nonzero EF in the snapshot or where
+      contrail_possible holds at an ERA5 hour between the two departures.
+      Every other edge keeps 0.0, a conservative approximation;
+    - "full": a fresh met load, REPLAN_MET_MARGIN_HOURS longer than the
+      flight's window, and EF evaluation; this resets the state.
+    The flight's previous route is kept to warm-start the search.
+    """
+
+    def __init__(self, max_flights=REPLAN_CACHE_SIZE, max_snapshots=REPLAN_SNAPSHOTS):
+        self.max_flights = max_flights
+        self.max_snapshots = max_snapshots
+        self._lock = threading.Lock()
+        self._states = OrderedDict()
+
+    @staticmethod
+    def geometry_key(dat):
+        """Everything that fixes the grid and EF except start_time."""
+        canonical = json.loads(route_cache_key(dat))
+        for field in (
+                "start_time", "lambda_value", "fuel_cost_per_km", "solver", "max_expansions",
+                "ef_lower_bound", "ef_mode", "ef_prefetch", "flight_id", "k_routes",
+                "refine_levels", "refine_corridor", "surrogate_top_k", "ef_field",
+        ):
+            canonical.pop(field, None)
+        return json.dumps(canonical, sort_keys=True)
+
+    def get(self, dat):
+        geometry = self.geometry_key(dat)
+        with self._lock:
+            state = self._states.get(dat.flight_id)
+            if state is None or state.geometry != geometry:
+                return None
+            self._states.move_to_end(dat.flight_id)
+            return state
+
+    def evaluate(self, dat, grid, progress=None, clock=None):
+        """Return ``(met_context, ef_values, ef_source, state)`` for an eager request.
+
+        ``clock``, a StageClock, is moved to "ef" once any met is loaded.
+        """
+        enter = (lambda stage: None) if clock is None else clock.enter
+        state = self.get(dat)
+        start_time = dat.start_time
+        snapshots = {}
+        if state is not None:
+            enter("ef")
+            # record() may change the snapshots from another request meanwhile
+            with self._lock:
+                snapshots = OrderedDict(state.snapshots)
+            if start_time in snapshots:
+                ef_values = snapshots[start_time]
+                EF_SEGMENTS.labels("reused").inc(len(ef_values))
+                _advance_progress(progress, len(ef_values))
+                return state.met_context, ef_values, "reused", state
+
+            earlier = [t for t in snapshots if t < start_time]
+            later = [t for t in snapshots if t > start_time]
+            if earlier and later:
+                t_a, t_b = max(earlier), min(later)
+                if t_b - t_a <= timedelta(minutes=REPLAN_INTERP_MINUTES):
+                    w = (start_time - t_a) / (t_b - t_a)
+                    ef_a = np.asarray(snapshots[t_a])
+                    ef_b = np.asarray(snapshots[t_b])
+                    ef_values = ((1.0 - w) * ef_a + w * ef_b).tolist()
+                    EF_SEGMENTS.labels("interpolated").inc(len(ef_values))
+                    _advance_progress(progress, len(ef_values))
+                    return state.met_context, ef_values, "interpolated", state
+
+        window_start, window_end, pressure_levels, bbox = met_window(dat, grid)
+        if state is not None:
+            met_context = state.met_context
+            have = _era5_hours(met_context.start_time, met_context.end_time)
+            need = _era5_hours(window_start, window_end)
+            covered = (
+                have[0] <= need[0] and need[1] <= have[1]
+                and met_context.pressure_levels == pressure_levels
+                and bbox_covers(met_context.bbox, bbox)
+            )
+            if not covered:
+                state = None
+
+        ef_source = "recomputed"
+        if state is None:
+            met_context = get_met_context(
+                window_start,
+                window_end + timedelta(hours=REPLAN_MET_MARGIN_HOURS),
+                pressure_levels,
+                bbox,
+            )
+            state = ReplanState(self.geometry_key(dat), met_context)
+            snapshots = {}
+            ef_source = "full"
+
+        enter("ef")
+        segments = grid.segments()
+        if snapshots:
+            nearest = min(snapshots, key=lambda t: abs(t - start_time))
+            ef_values = np.array(snapshots[nearest], dtype=float)
+            hours = pd.date_range(*_era5_hours(min(nearest, start_time), max(nearest, start_time)), freq="h")
+            changed = np.flatnonzero(
+                (ef_values != 0.0) | contrail_possible(state.met_context.met, hours, segments)
+            )
+        else:
+            ef_values = np.zeros(len(segments))
+            changed = np.arange(len(segments))
+
+        EF_SEGMENTS.labels("reused").inc(len(segments) - len(changed))
+        _advance_progress(progress, len(segments) - len(changed))
+        if len(changed):
+            ef_values[changed] = compute_ef_parallel(
+                start_time=start_time,
+                duration_hours=dat.duration_hours,
+                segments=[segments[k] for k in changed],
+                aircraft_type=dat.aircraft_type,
+                met_context=state.met_context,
+                progress=progress,
+            )
+        return state.met_context, ef_values.tolist(), ef_source, state
+
+    def record(self, dat, state, ef_values, path):
+        """Store this plan's EF snapshot and route as the flight's latest state."""
+        with self._lock:
+            state.snapshots[dat.start_time] = ef_values
+            state.snapshots.move_to_end(dat.start_time)
+            while len(state.snapshots) > self.max_snapshots:
+                state.snapshots.popitem(last=False)
+            state.path = path
+            self._states[dat.flight_id] = state
+            self._states.move_to_end(dat.flight_id)
+            while len(self._states) > self.max_flights:
+                self._states.popitem(last=False)
+
+
+replan_store = ReplanStore()
+
+
+def compute_route(dat, progress=None, met_context=None, ef_values=None, grid=None, clock=None):
+    """Build the grid, evaluate EF and solve for the cheapest route.
+
+    EF is evaluated for every edge up front, or on demand as the search
+    reaches each edge when ``ef_mode`` is "lazy" (dijkstra/astar only).
+    If ``progress`` is a dict it is updated live with the current ``stage``,
+    ``edges_total``, ``edges_evaluated`` and ``nodes_expanded``.
+    ``met_context`` and eager ``ef_values`` (in grid edge order) may be passed
+    in when they were already computed for a batch of requests. An eager
+    request with a ``flight_id`` takes its met and EF from replan_store and
+    warm-starts dijkstra/astar with the flight's previous route. ``grid``
+    replaces the request's own grid, as for refinement passes. Unless a grid
+    or ``ef_values`` is passed in, surrogate mode requests are handed to
+    compute_route_surrogate and requests with ``refine_levels`` to
+    compute_route_refined. ``clock`` is the caller's StageClock, which the
+    caller then finishes; by default the route gets its own.
+    Returns a RouteResult ``(total_cost, path, grid, stats, routes)``, where stats holds the
+    solver's expansion counters and EF evaluation counts. Raises a 422 if no route is found,
+    e.g. when dijkstra exhausts ``max_expansions``, or when ``k_routes`` is
+    outside 1..K_ROUTES_MAX.
+    """
+    if not 1 <= dat.k_routes <= K_ROUTES_MAX:
+        raise HTTPException(status_code=422, detail=f"k_routes must be between 1 and {K_ROUTES_MAX}.")
+    if grid is None and ef_values is None:
+        if dat.ef_mode == "surrogate":
+            return compute_route_surrogate(dat, progress, met_context)
+        if dat.refine_levels:
+            return compute_route_refined(dat, progress, met_context)
+    if progress is None:
+        progress = {}
+    own_clock = clock is None
+    if own_clock:
+        clock = StageClock(progress)
+    try:
+        # 1. Build a layered grid of waypoints between start and end:
+        #    lateral options x flight levels in every column
+        clock.enter("grid")
+        if grid is None:
+            grid = build_route_grid(dat)
+
+        # 2. Edges connect each node in column i to every node in column i+1 that is
+        #    at most one flight level (and max_lateral_change rows) away. They are
+        #    generated on demand from the grid, forward only.
+        graph = grid.graph()
+        num_edges = graph.num_edges
+        progress.update(edges_total=num_edges, edges_evaluated=0, nodes_expanded=0)
+        cocip_before = progress.get("ef_cocip", 0)
+
+        # 3. Load met for the flight levels the grid needs
+        clock.enter("met")
+        lazy = uses_lazy_ef(dat)
+        replan = None
+        field = None if lazy or ef_values is not None else resolve_ef_field(dat, grid)
+        if field is not None:
+            # Precomputed EF field: no met and no CoCiP, just interpolation
+            clock.enter("ef")
+            ef_values = field.segment_ef(dat.start_time, grid.segments())
+            EF_SEGMENTS.labels("field").inc(len(ef_values))
+            _advance_progress(progress, len(ef_values))
+        elif dat.flight_id is not None and not lazy and ef_values is None:
+            met_context, ef_values, ef_source, replan = replan_store.evaluate(dat, grid, progress, clock)
+        elif met_context is None and (lazy or ef_values is None):
+            met_context = get_met_context(*met_window(dat, grid))
+
+        # 4. Edge costs: fuel cost (proportional to haversine distance) + lambda * EF,
+        #    one value per edge in edge order. The dag solver works on dense
+        #    (n_cols - 1, n_states, n_states) layer arrays instead.
+        clock.enter("ef")
+        fuel_costs = dat.fuel_cost_per_km * grid.edge_distances_km()
+
+        if lazy:
+            # EF is computed the first time the search relaxes an edge
+            if dat.solver == "astar" and dat.ef_lower_bound is None:
+                raise HTTPException(
+                    status_code=422,
+                    detail="astar with lazy EF needs ef_lower_bound to keep its heuristic admissible.",
+                )
+            ef_cache = LazyEdgeEF(
+                grid,
                 start_time=dat.start_time,
                 duration_hours=dat.duration_hours,
-                longs=[lon_a, lon_b],
-                lats=[lat_a, lat_b],
-                altitude_ft=altitude_ft,
-                aircraft_type=aircraft_type,
+                aircraft_type=dat.aircraft_type,
+                met_context=met_context,
+                prefetch=dat.ef_prefetch,
+                progress=progress,
+            )
+            cost_fn = lazy_flat_cost_fn(graph, fuel_costs, dat.lambda_value, ef_cache)
+        else:
+            # Precompute EF for every edge in batched CoCiP runs spread over the EF worker pool
+            if ef_values is None:
+                ef_values = compute_ef_parallel(
+                    start_time=dat.start_time,
+                    duration_hours=dat.duration_hours,
+                    segments=grid.segments(),
+                    aircraft_type=dat.aircraft_type,
+                    met_context=met_context,
+                    progress=progress,
+                )
+            else:
+                _advance_progress(progress, len(ef_values))
+            if dat.solver == "dag":
+                layer_fuel_costs = dat.fuel_cost_per_km * grid.layer_distances_km()
+                edge_costs = grid.mask_disallowed(
+                    layer_fuel_costs + dat.lambda_value * grid.scatter(ef_values)
+                )
+            else:
+                weights = (fuel_costs + dat.lambda_value * np.asarray(ef_values, dtype=float)).tolist()
+                cost_fn = flat_cost_fn(weights)
+
+        # 5. Start and end nodes: centre row at the middle flight level
+        start_node = grid.start_node
+        end_node = grid.end_node
+
+        # Warm start: the flight's previous route, re-costed, bounds the search
+        warm_start = {}
+        if replan is not None and replan.path and dat.solver != "dag":
+            ef_lower_bound = dat.ef_lower_bound
+            if ef_lower_bound is None:
+                ef_lower_bound = min(ef_values, default=0.0)
+            incumbent_cost = graph.path_cost(replan.path, weights)
+            warm_start = {
+                "upper_bound": incumbent_cost + 1e-9 * max(1.0, abs(incumbent_cost)),
+                "lower_bound": great_circle_heuristic(
+                    grid, dat.fuel_cost_per_km, dat.lambda_value, ef_lower_bound
+                ),
+            }
+
+        # 6. Run the selected solver; dijkstra/astar update nodes_expanded live
+        clock.enter("search")
+        if dat.solver == "dag":
+            total_cost, path = solve_layered_dag(edge_costs, start_node[1], end_node[1])
+            # The DP visits every node and relaxes every edge once
+            progress.update(
+                nodes_expanded=grid.n_cols * grid.n_states, edges_relaxed=num_edges, heap_operations=0,
+            )
+        elif dat.solver == "astar":
+            ef_lower_bound = dat.ef_lower_bound
+            if ef_lower_bound is None:
+                ef_lower_bound = min(ef_values, default=0.0)
+            heuristic = great_circle_heuristic(
+                grid, dat.fuel_cost_per_km, dat.lambda_value, ef_lower_bound
+            )
+            total_cost, path = grid_dijkstra(
+                graph, start_node, end_node, cost_fn, heuristic=heuristic,
+                max_expansions=dat.max_expansions, stats=progress, **warm_start,
+            )
+        else:
+            total_cost, path = grid_dijkstra(
+                graph, start_node, end_node, cost_fn,
+                max_expansions=dat.max_expansions, stats=progress, **warm_start,
             )
-            ef_cache[(a, b)] = sum(ef_values) if ef_values else 0.0
-        except Exception:
-            ef_cache[(a, b)] = 0.0
 
-    # 4. Define cost function: fuel cost (proportional to distance) + lambda * EF
-    def cost_fn(coord_from, coord_to):
-        lon_a, lat_a = grid[coord_from]
-        lon_b, lat_b = grid[coord_to]
-        # Approximate distance in km (haversine-lite)
-        dlat = np.radians(lat_b - lat_a)
-        dlon = np.radians(lon_b - lon_a)
-        a_h = np.sin(dlat / 2) ** 2 + np.cos(np.radians(lat_a)) * np.cos(np.radians(lat_b)) * np.sin(dlon / 2) ** 2
-        dist_km = 6371 * 2 * np.arctan2(np.sqrt(a_h), np.sqrt(1 - a_h))
+        # Segments CoCiP actually ran for; store, field, snapshot and unneeded
+        # lazy edges all count as skipped
+        ef_evaluated = progress.get("ef_cocip", 0) - cocip_before
+        stats = {
+            "nodes_expanded": progress["nodes_expanded"],
+            "edges_relaxed": progress["edges_relaxed"],
+            "ef_evaluated": ef_evaluated,
+            "ef_skipped": num_edges - ef_evaluated,
+        }
+        if field is not None:
+            stats["ef_field"] = field.name
+        if replan is not None:
+            stats["ef_source"] = ef_source
+            if warm_start:
+                stats["nodes_pruned"] = progress["nodes_pruned"]
+                if not path and dat.max_expansions is None:
+                    # Nothing beat the incumbent: the previous route is still optimal
+                    total_cost, path = graph.path_cost(replan.path, weights), replan.path
+
+        # 7. Alternatives: the k_routes cheapest distinct routes, best first. dag
+        #    ranks them in one k-best DP; dijkstra/astar run Yen's spur searches on
+        #    the same cost function, so lazily evaluated EF is shared. The spur
+        #    searches need a lower bound on the remaining cost to stay exact and
+        #    prune soundly when EF makes edge costs negative.
+        routes = None
+        if dat.k_routes > 1 and path:
+            if dat.solver == "dag":
+                ranked = solve_layered_dag_kbest(edge_costs, start_node[1], end_node[1], dat.k_routes)
+            else:
+                ef_lower_bound = dat.ef_lower_bound
+                if ef_lower_bound is None and not lazy:
+                    ef_lower_bound = min(ef_values, default=0.0)
+                lower_bound = None
+                if ef_lower_bound is not None:
+                    lower_bound = great_circle_heuristic(
+                        grid, dat.fuel_cost_per_km, dat.lambda_value, ef_lower_bound
+                    )
+                k_stats = {}
+                ranked = grid_k_shortest(
+                    graph, start_node, end_node, cost_fn, dat.k_routes, first=(total_cost, path),
+                    heuristic=heuristic if dat.solver == "astar" else None, lower_bound=lower_bound,
+                    max_expansions=dat.max_expansions, stats=k_stats,
+                )
+                stats["k_routes"] = k_stats
+                SEARCH_NODES_EXPANDED.labels(dat.solver).inc(k_stats["nodes_expanded"])
+                SEARCH_EDGES_RELAXED.labels(dat.solver).inc(k_stats["edges_relaxed"])
+                SEARCH_HEAP_OPERATIONS.labels(dat.solver).inc(k_stats["heap_operations"])
+                # dijkstra's own route can be beaten when EF makes costs negative
+                total_cost, path = ranked[0]
+            routes = []
+            for route_cost, route in ranked:
+                fuel_cost = ef = 0.0
+                for u, v in zip(route, route[1:]):
+                    edge = graph.edge_id(u, v)
+                    fuel_cost += fuel_costs[edge]
+                    ef += ef_cache(u[0], u[1], v[1]) if lazy else ef_values[edge]
+                routes.append({
+                    "total_cost": route_cost, "fuel_cost": float(fuel_cost), "ef": float(ef), "path": route,
+                })
+            if lazy:
+                ef_evaluated = progress.get("ef_cocip", 0) - cocip_before
+                stats.update(ef_evaluated=ef_evaluated, ef_skipped=num_edges - ef_evaluated)
+        if replan is not None and path:
+            replan_store.record(dat, replan, ef_values, path)
+        SEARCH_NODES_EXPANDED.labels(dat.solver).inc(progress["nodes_expanded"])
+        SEARCH_EDGES_RELAXED.labels(dat.solver).inc(progress["edges_relaxed"])
+        SEARCH_HEAP_OPERATIONS.labels(dat.solver).inc(progress["heap_operations"])
+
+        if not path:
+            raise HTTPException(
+                status_code=422,
+                detail="No route found. Try raising max_expansions or reducing grid density.",
+            )
 
-        fuel_cost = dat.fuel_cost_per_km * dist_km
-        ef_cost = dat.lambda_value * ef_cache.get((coord_from, coord_to), 0.0)
-        return fuel_cost + ef_cost
+        return RouteResult(total_cost, path, grid, stats, routes)
+    finally:
+        if own_clock:
+            clock.finish()
 
-    # 5. Find start and end nodes (closest grid nodes)
-    start_node = (0, n // 2)
-    end_node = (n - 1, n // 2)
 
-    # 6. Run Dijkstra
-    total_cost, path = dijkstra(edges, start_node, end_node, cost_fn)
+def compute_route_refined(dat, progress=None, met_context=None):
+    """Coarse-to-fine route search for large grids.
 
-    # 7. Convert path back to lon/lat
-    waypoints = [{"longitude": grid[node][0], "latitude": grid[node][1]} for node in path]
+    The first pass solves on every ``2 ** refine_levels``-th lateral row of
+    the request's grid. Each further pass halves the row spacing and keeps
+    only ``refine_corridor`` rows either side of the previous route, until
+    the last pass runs at full resolution. Every pass keeps all columns and
+    flight levels, since edges grow with the square of the rows. Segment EF
+    is evaluated once and reused by later passes, so CoCiP only runs near
+    the route. Returns a RouteResult on the last pass's corridor grid, with
+    per-pass counts in ``stats["refine_passes"]``.
+    """
+    if progress is None:
+        progress = {}
+    if uses_lazy_ef(dat):
+        raise HTTPException(status_code=422, detail="refine_levels needs ef_mode 'eager'.")
+    if dat.refine_levels < 0 or dat.refine_corridor < 1:
+        raise HTTPException(status_code=422, detail="refine_levels must be >= 0 and refine_corridor >= 1.")
+    # One clock for the whole job, so passes do not report "done" early
+    clock = StageClock(progress)
+    try:
+        clock.enter("grid")
+        grid = build_route_grid(dat)
+        clock.enter("met")
+        field = resolve_ef_field(dat, grid)
+        if field is None and met_context is None:
+            met_context = get_met_context(*met_window(dat, grid))
+
+        known_ef = {}
+        passes = []
+        cocip_before = progress.get("ef_cocip", 0)
+        nodes_expanded = edges_relaxed = 0
+        centres = np.full(grid.n_cols, grid.n_rows // 2)
+        half_width = grid.n_rows
+        for level in range(dat.refine_levels, -1, -1):
+            stride = 2 ** level
+            rows = corridor_rows(grid.n_rows, centres, stride, half_width)
+            max_lateral_change = dat.max_lateral_change
+            if max_lateral_change is not None:
+                max_lateral_change = max(1, max_lateral_change // stride)
+            pass_grid = grid.subgrid(rows, max_lateral_change)
+
+            segments = pass_grid.segments()
+            missing = list(dict.fromkeys(segment for segment in segments if segment not in known_ef))
+            pass_cocip = progress.get("ef_cocip", 0)
+            clock.enter("ef")
+            if field is not None:
+                new_values = field.segment_ef(dat.start_time, missing)
+                EF_SEGMENTS.labels("field").inc(len(new_values))
+            else:
+                new_values = compute_ef_parallel(
+                    start_time=dat.start_time,
+                    duration_hours=dat.duration_hours,
+                    segments=missing,
+                    aircraft_type=dat.aircraft_type,
+                    met_context=met_context,
+                    progress=progress,
+                )
+            known_ef.update(zip(missing, new_values))
+            pass_cocip = progress.get("ef_cocip", 0) - pass_cocip
+
+            progress["refine_pass"] = len(passes) + 1
+            # Only the full-resolution pass ranks alternatives
+            pass_dat = dat if level == 0 else dat.model_copy(update={"k_routes": 1})
+            result = compute_route(
+                pass_dat, progress, met_context=met_context,
+                ef_values=[known_ef[segment] for segment in segments], grid=pass_grid, clock=clock,
+            )
+            nodes_expanded += result.stats["nodes_expanded"]
+            edges_relaxed += result.stats["edges_relaxed"]
+            passes.append({
+                "row_stride": stride,
+                "rows": pass_grid.n_rows,
+                "edges": len(segments),
+                "ef_evaluated": pass_cocip,
+                "total_cost": result.total_cost,
+            })
+            centres = [rows[i, pass_grid.state_rows[s]] for i, s in result.path]
+            half_width = dat.refine_corridor
+
+        ef_evaluated = progress.get("ef_cocip", 0) - cocip_before
+        stats = dict(
+            result.stats,
+            nodes_expanded=nodes_expanded,
+            edges_relaxed=edges_relaxed,
+            ef_evaluated=ef_evaluated,
+            ef_skipped=grid.graph().num_edges - ef_evaluated,
+            refine_passes=passes,
+        )
+        if field is not None:
+            stats["ef_field"] = field.name
+        return RouteResult(result.total_cost, result.path, result.grid, stats, result.routes)
+    finally:
+        clock.finish()
+
+
+def compute_route_surrogate(dat, progress=None, met_context=None):
+    """Shortlist routes with surrogate EF, then cost the shortlist with CoCiP.
+
+    Every edge is scored with surrogate_segment_ef on the loaded met, and
+    the ``surrogate_top_k`` cheapest routes under fuel + lambda * surrogate
+    EF are found in one k-best layered DP. CoCiP then runs only on the edges
+    of those routes, and the route with the lowest exact cost is returned.
+    ``stats["surrogate_candidates"]`` lists each shortlisted route's
+    surrogate and exact cost, in surrogate order. The ``solver`` field does
+    not apply, and ``k_routes`` alternatives come from the shortlist.
+    """
+    if progress is None:
+        progress = {}
+    if not 1 <= dat.surrogate_top_k <= SURROGATE_TOP_K_MAX:
+        raise HTTPException(
+            status_code=422, detail=f"surrogate_top_k must be between 1 and {SURROGATE_TOP_K_MAX}.",
+        )
+    clock = StageClock(progress)
+    try:
+        clock.enter("grid")
+        grid = build_route_grid(dat)
+        graph = grid.graph()
+        num_edges = graph.num_edges
+        progress.update(edges_total=num_edges, edges_evaluated=0, nodes_expanded=0)
+        cocip_before = progress.get("ef_cocip", 0)
+
+        clock.enter("met")
+        if met_context is None:
+            met_context = get_met_context(*met_window(dat, grid))
+
+        clock.enter("ef")
+        segments = grid.segments()
+        surrogate_ef = surrogate_segment_ef(met_context.met, dat.start_time, segments)
+        EF_SEGMENTS.labels("surrogate").inc(len(surrogate_ef))
+        surrogate_costs = grid.mask_disallowed(
+            dat.fuel_cost_per_km * grid.layer_distances_km()
+            + dat.lambda_value * grid.scatter(surrogate_ef)
+        )
 
-    return {
+        clock.enter("search")
+        candidates = solve_layered_dag_kbest(
+            surrogate_costs, grid.start_node[1], grid.end_node[1], dat.surrogate_top_k,
+        )
+        progress.update(
+            nodes_expanded=grid.n_cols * grid.n_states, edges_relaxed=num_edges, heap_operations=0,
+        )
+        if not candidates:
+            raise HTTPException(status_code=422, detail="No route found.")
+
+        # Exact EF only for the edges the shortlisted routes use
+        clock.enter("ef")
+        route_edges = [
+            [graph.edge_id(u, v) for u, v in zip(path, path[1:])] for _cost, path in candidates
+        ]
+        exact_edges = sorted(set().union(*route_edges))
+        progress.update(edges_total=len(exact_edges))
+        exact_ef = dict(zip(exact_edges, compute_ef_parallel(
+            start_time=dat.start_time,
+            duration_hours=dat.duration_hours,
+            segments=[segments[e] for e in exact_edges],
+            aircraft_type=dat.aircraft_type,
+            met_context=met_context,
+            progress=progress,
+        )))
+        fuel_costs = dat.fuel_cost_per_km * grid.edge_distances_km()
+        fuel_sums = [float(sum(fuel_costs[e] for e in edges)) for edges in route_edges]
+        ef_sums = [float(sum(exact_ef[e] for e in edges)) for edges in route_edges]
+        exact_costs = [fuel + dat.lambda_value * ef for fuel, ef in zip(fuel_sums, ef_sums)]
+        best = int(np.argmin(exact_costs))
+        ef_evaluated = progress.get("ef_cocip", 0) - cocip_before
+
+        surrogate_cost, path = candidates[best]
+        total_cost = exact_costs[best]
+        SURROGATE_RELATIVE_ERROR.observe(abs(surrogate_cost - total_cost) / max(abs(total_cost), 1e-12))
+        SEARCH_NODES_EXPANDED.labels("dag").inc(progress["nodes_expanded"])
+        SEARCH_EDGES_RELAXED.labels("dag").inc(progress["edges_relaxed"])
+
+        stats = {
+            "nodes_expanded": progress["nodes_expanded"],
+            "edges_relaxed": progress["edges_relaxed"],
+            "ef_evaluated": ef_evaluated,
+            "ef_skipped": num_edges - ef_evaluated,
+            "surrogate_cost": surrogate_cost,
+            "surrogate_candidates": [
+                {"surrogate_cost": cost, "exact_cost": exact}
+                for (cost, _path), exact in zip(candidates, exact_costs)
+            ],
+        }
+        # Alternatives are the shortlisted routes ranked by exact cost
+        routes = None
+        if dat.k_routes > 1:
+            routes = [
+                {
+                    "total_cost": exact_costs[r], "fuel_cost": fuel_sums[r], "ef": ef_sums[r],
+                    "path": candidates[r][1],
+                }
+                for r in sorted(range(len(candidates)), key=exact_costs.__getitem__)[:dat.k_routes]
+            ]
+        return RouteResult(total_cost, path, grid, stats, routes)
+    finally:
+        clock.finish()
+
+
+def route_cache_key(dat):
+    """Canonical JSON for a FlightData, so equivalent requests share one key."""
+    canonical = dat.model_dump(mode="json")
+    start_time = dat.start_time
+    if start_time.tzinfo is not None:
+        start_time = start_time.astimezone(timezone.utc).replace(tzinfo=None)
+    canonical["start_time"] = start_time.isoformat()
+    canonical["altitudes_ft"] = sorted(float(a) for a in dat.altitudes_ft)
+    return json.dumps(canonical, sort_keys=True)
+
+
+class RouteService:
+    """Shared route computation for both endpoints.
+
+    Results are kept in an LRU keyed by the canonicalised FlightData, so
+    /optimum_ef_route_onchain is a cheap projection of a route that
+    /optimum_ef_route already computed, and vice versa. Concurrent identical
+    requests are coalesced: the first one computes, the rest wait for its
+    result (or its exception). A result computed on a ``met_context`` passed
+    in, as batches do with their shared slice, is keyed by that slice too,
+    so a plain request never gets EF from a slice it did not ask for.
+    """
+
+    def __init__(self, max_entries=ROUTE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._results = OrderedDict()
+        self._in_flight = {}
+
+    @staticmethod
+    def key(dat, met_context=None):
+        key = route_cache_key(dat)
+        if met_context is not None:
+            key = f"{key}|{met_context!r}"
+        return key
+
+    def cached(self, dat, met_context=None):
+        """Return the cached result for ``dat``, or None, without computing it."""
+        with self._lock:
+            return self._results.get(self.key(dat, met_context))
+
+    def get(self, dat, progress=None, **compute_kwargs):
+        key = self.key(dat, compute_kwargs.get("met_context"))
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                if progress is not None:
+                    progress["stage"] = "done"
+                ROUTE_CACHE_LOOKUPS.labels("hit").inc()
+                return self._results[key]
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._in_flight[key] = future
+        ROUTE_CACHE_LOOKUPS.labels("miss" if owner else "coalesced").inc()
+
+        if not owner:
+            return future.result()
+
+        try:
+            result = compute_route(dat, progress, **compute_kwargs)
+        except BaseException as exc:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(exc)
+            raise
+
+        with self._lock:
+            del self._in_flight[key]
+            self._results[key] = result
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+        future.set_result(result)
+        return result
+
+
+route_service = RouteService()
+
+
+def route_response(result):
+    total_cost, path, grid, stats, routes = result
+
+    # 8. Convert path back to lon/lat/altitude
+    waypoints = grid.waypoints(path)
+
+    response = {
         "total_cost": total_cost,
         "waypoints": waypoints,
         "num_nodes": len(path),
-
+        "search_stats": stats,
     }
+    if routes is not None:
+        response["routes"] = [
+            {
+                "total_cost": route["total_cost"],
+                "fuel_cost": route["fuel_cost"],
+                "ef": route["ef"],
+                "waypoints": grid.waypoints(route["path"]),
+            }
+            for route in routes
+        ]
+    return response
+
+
+def iter_route_batch(dats):
+    """Yield ``(index, result)`` for each request as its route finishes.
+
+    Requests are grouped by met slice so every ERA5 window is loaded once.
+    Eager, unrefined requests in a group that share an aircraft type, do not
+    ask for an ``ef_field`` and are not yet cached get their segment EF from
+    a single compute_ef_parallel call, with segments common to several grids
+    evaluated once. A request that fails yields its exception in place of a
+    result.
+    """
+    groups = OrderedDict()
+    for index, dat in enumerate(dats):
+        try:
+            grid = build_route_grid(dat)
+        except Exception as exc:
+            yield index, exc
+            continue
+        start_time, end_time, pressure_levels, bbox = met_window(dat, grid)
+        groups.setdefault((start_time, end_time, pressure_levels), []).append(
+            (index, dat, grid, bbox)
+        )
+
+    for (start_time, end_time, pressure_levels), members in groups.items():
+        # One met slice over the union of the group's boxes
+        bbox = union_bbox(member[3] for member in members)
+        members = [member[:3] for member in members]
+        # The group's own met and shared EF stages; each route then times its own
+        clock = StageClock({})
+        clock.enter("met")
+        try:
+            met_context = get_met_context(start_time, end_time, pressure_levels, bbox)
+        except Exception as exc:
+            clock.finish()
+            for index, _dat, _grid in members:
+                yield index, exc
+            continue
+
+        by_aircraft = OrderedDict()
+        for index, dat, grid in members:
+            if (
+                    dat.ef_mode != "surrogate" and not uses_lazy_ef(dat) and not dat.refine_levels
+                    and dat.ef_field is None and route_service.cached(dat, met_context) is None
+            ):
+                by_aircraft.setdefault(dat.aircraft_type, []).append((index, dat, grid))
+
+        shared_ef = {}
+        clock.enter("ef")
+        try:
+            for aircraft_type, requests in by_aircraft.items():
+                segments = {index: grid.segments() for index, _dat, grid in requests}
+                unique = {}
+                for request_segments in segments.values():
+                    for segment in request_segments:
+                        unique.setdefault(segment, len(unique))
+                ef_values = compute_ef_parallel(
+                    start_time=start_time,
+                    duration_hours=requests[0][1].duration_hours,
+                    segments=list(unique),
+                    aircraft_type=aircraft_type,
+                    met_context=met_context,
+                    pressure_levels=pressure_levels,
+                )
+                for index, request_segments in segments.items():
+                    shared_ef[index] = [ef_values[unique[segment]] for segment in request_segments]
+        finally:
+            clock.finish()
+
+        for index, dat, _grid in members:
+            try:
+                result = route_service.get(
+                    dat, met_context=met_context, ef_values=shared_ef.get(index)
+                )
+            except Exception as exc:
+                yield index, exc
+                continue
+            yield index, result
+
+
+def lambda_sweep(req):
+    """The lambda values a ParetoRequest asks for, in request order."""
+    too_many = HTTPException(status_code=422, detail=f"At most {PARETO_MAX_LAMBDAS} lambda values per sweep.")
+    if req.lambda_values:
+        if len(req.lambda_values) > PARETO_MAX_LAMBDAS:
+            raise too_many
+        lambda_values = req.lambda_values
+    elif req.lambda_min is not None and req.lambda_max is not None:
+        # Checked before the values are built, so a huge lambda_steps costs nothing
+        if req.lambda_steps < 1:
+            raise HTTPException(status_code=422, detail="lambda_steps must be >= 1.")
+        if req.lambda_steps > PARETO_MAX_LAMBDAS:
+            raise too_many
+        if req.lambda_spacing == "log":
+            if req.lambda_min <= 0 or req.lambda_max <= 0:
+                raise HTTPException(status_code=422, detail="log spacing needs positive lambda_min and lambda_max.")
+            lambda_values = np.geomspace(req.lambda_min, req.lambda_max, req.lambda_steps)
+        else:
+            lambda_values = np.linspace(req.lambda_min, req.lambda_max, req.lambda_steps)
+    else:
+        raise HTTPException(status_code=422, detail="Give lambda_values or lambda_min and lambda_max.")
+    return [float(v) for v in lambda_values]
+
+
+def pareto_front(points):
+    """Indices of the (fuel, ef) points no other point dominates, by ascending fuel."""
+    front = [
+        k for k, (fuel, ef) in enumerate(points)
+        if not any(
+            f <= fuel and e <= ef and (f < fuel or e < ef)
+            for f, e in points
+        )
+    ]
+    return sorted(front, key=lambda k: points[k])
+
+
+def compute_pareto(req):
+    """Solve one route per lambda, sharing a single grid and EF evaluation.
+
+    ``lambda_value`` only enters the edge costs, so the grid, met slice and
+    every segment's EF are computed once (always eagerly) and reused for the
+    whole sweep. With ``ef_field``, EF comes from that field instead of
+    CoCiP, as for a single route. The dag solver handles all lambdas in one vectorised pass;
+    dijkstra/astar solve each lambda in turn on the shared EF, both as A*
+    with great_circle_heuristic, which stays exact when negative EF makes
+    edge costs negative. The sweep runs on the full grid, so
+    ``refine_levels`` is rejected.
+    """
+    if req.refine_levels:
+        raise HTTPException(status_code=422, detail="refine_levels does not apply to a pareto sweep.")
+    lambda_values = lambda_sweep(req)
+    progress = {}
+
+    clock = StageClock(progress)
+    try:
+        clock.enter("grid")
+        grid = build_route_grid(req)
+        clock.enter("met")
+        field = resolve_ef_field(req, grid)
+        if field is not None:
+            met_context = None
+            clock.enter("ef")
+            ef_values = field.segment_ef(req.start_time, grid.segments())
+            EF_SEGMENTS.labels("field").inc(len(ef_values))
+        else:
+            met_context = get_met_context(*met_window(req, grid))
+            clock.enter("ef")
+            ef_values = compute_ef_parallel(
+                start_time=req.start_time,
+                duration_hours=req.duration_hours,
+                segments=grid.segments(),
+                aircraft_type=req.aircraft_type,
+                met_context=met_context,
+                progress=progress,
+            )
+        ef_evaluated = progress.get("ef_cocip", 0)
+        fuel_costs = req.fuel_cost_per_km * grid.layer_distances_km()
+        ef_costs = grid.scatter(ef_values)
+
+        clock.enter("search")
+        if req.solver == "dag":
+            solved = solve_layered_dag_sweep(
+                grid.mask_disallowed(fuel_costs), ef_costs, lambda_values,
+                grid.start_node[1], grid.end_node[1],
+            )
+            if any(not path for _, path in solved):
+                raise HTTPException(status_code=422, detail="No route found for every lambda.")
+        else:
+            solved = []
+            for lambda_value in lambda_values:
+                dat = req.model_copy(update={
+                    "lambda_value": lambda_value, "solver": "astar", "ef_mode": "eager", "k_routes": 1,
+                    "ef_field": None,
+                })
+                result = compute_route(
+                    dat, progress, met_context=met_context, ef_values=ef_values, grid=grid, clock=clock,
+                )
+                solved.append((result.total_cost, result.path))
+    finally:
+        clock.finish()
+
+    routes = []
+    for lambda_value, (total_cost, path) in zip(lambda_values, solved):
+        routes.append({
+            "lambda_value": lambda_value,
+            "total_cost": total_cost,
+            "fuel_cost": path_layer_sums(path, fuel_costs),
+            "ef": path_layer_sums(path, ef_costs),
+            "waypoints": grid.waypoints(path),
+            "num_nodes": len(path),
+        })
+
+    front = pareto_front([(route["fuel_cost"], route["ef"]) for route in routes])
+    for k, route in enumerate(routes):
+        route["pareto_optimal"] = k in front
+
+    response = {"routes": routes, "pareto_front": front, "ef_evaluated": ef_evaluated}
+    if field is not None:
+        response["ef_field"] = field.name
+    return response
+
+
+def _run_route_job(dat, progress):
+    return route_response(route_service.get(dat, progress))
+
+
+# Background optimisation jobs: worker threads and max queued-or-running jobs
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "32"))
+# Largest number of requests accepted by one /optimum_ef_route/batch call
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", "500"))
+# Largest number of lambda values accepted by one /optimum_ef_route/pareto call
+PARETO_MAX_LAMBDAS = int(os.getenv("PARETO_MAX_LAMBDAS", "200"))
+# Seconds between progress events on the SSE stream
+JOB_EVENT_INTERVAL = float(os.getenv("JOB_EVENT_INTERVAL", "0.5"))
+
+job_manager = JobManager(_run_route_job, max_workers=JOB_WORKERS, max_pending=JOB_QUEUE_SIZE)
+
+
+@app.post("/optimum_ef_route")
+def main(dat: FlightData):
+    return route_response(route_service.get(dat))
+
+
+@app.post("/optimum_ef_route/batch")
+def batch_route(dats: List[FlightData]):
+    """Optimise many flights in one call, streaming NDJSON as each route finishes.
+
+    Each line is ``{"index": i, ...}`` with the /optimum_ef_route response for
+    request ``i``, or ``{"index": i, "error": ..., "status_code": ...}`` if it
+    failed. Lines arrive grouped by met window, not in request order.
+    """
+    if len(dats) > BATCH_MAX_REQUESTS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {BATCH_MAX_REQUESTS} requests per batch.",
+        )
+
+    def lines():
+        for index, result in iter_route_batch(dats):
+            if isinstance(result, Exception):
+                line = {
+                    "index": index,
+                    "error": getattr(result, "detail", None) or str(result),
+                    "status_code": getattr(result, "status_code", 500),
+                }
+            else:
+                line = {"index": index, **route_response(result)}
+            yield json.dumps(line) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.post("/optimum_ef_route/pareto")
+def pareto_route(req: ParetoRequest):
+    """One route per lambda plus the fuel-vs-EF Pareto front, from one EF evaluation.
+
+    ``pareto_front`` lists the indices of non-dominated routes by ascending fuel cost.
+    """
+    return compute_pareto(req)
+
+
+@app.post("/ef_fields", status_code=202)
+def submit_ef_field(spec: EFFieldRequest):
+    """Queue an EF field build; follow it with the /jobs/{job_id} endpoints."""
+    if not re.fullmatch(r"[A-Za-z0-9_-]+", spec.name) or spec.name == "auto":
+        raise HTTPException(status_code=422, detail="EF field names may only use letters, digits, '_' and '-'.")
+    try:
+        job = job_manager.submit(spec, run_fn=build_ef_field)
+    except JobQueueFull:
+        raise HTTPException(status_code=429, detail="Too many optimisation jobs queued. Retry later.")
+    return {"job_id": job.id, "status": job.status}
+
+
+@app.get("/ef_fields")
+def list_ef_fields():
+    fields = []
+    for name in ef_field_store.names():
+        field = ef_field_store.load(name)
+        if field is None:
+            continue
+        fields.append({
+            "name": field.name,
+            "aircraft_type": field.aircraft_type,
+            "duration_hours": field.duration_hours,
+            "lon_range": [float(field.lons[0]), float(field.lons[-1])],
+            "lat_range": [float(field.lats[0]), float(field.lats[-1])],
+            "altitudes_ft": field.altitudes_ft.tolist(),
+            "times": [
+                datetime.fromtimestamp(t, tz=timezone.utc).isoformat() for t in field.times
+            ],
+            "shape": list(field.values.shape),
+        })
+    return {"fields": fields}
+
+
+@app.post("/jobs", status_code=202)
+def submit_route_job(dat: FlightData):
+    """Queue an /optimum_ef_route computation and return its job id immediately."""
+    try:
+        job = job_manager.submit(dat)
+    except JobQueueFull:
+        raise HTTPException(status_code=429, detail="Too many optimisation jobs queued. Retry later.")
+    return {"job_id": job.id, "status": job.status}
+
+
+@app.get("/jobs/{job_id}")
+def get_route_job(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+    return job.to_dict()
+
+
+@app.get("/jobs/{job_id}/events")
+async def stream_route_job(job_id: str):
+    """Server-sent events: a ``progress`` event whenever progress changes,
+    then one ``done`` or ``failed`` event with the final job state."""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+
+    async def events():
+        last = None
+        while not job.finished:
+            state = job.to_dict()
+            snapshot = (state["status"], state["progress"])
+            if snapshot != last:
+                last = snapshot
+                yield f"event: progress\ndata: {json.dumps(state)}\n\n"
+            await asyncio.sleep(JOB_EVENT_INTERVAL)
+        yield f"event: {job.status}\ndata: {json.dumps(job.to_dict())}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
 
 @app.post("/optimum_ef_route_onchain")
 def main_onchain(dat: FlightData):
@@ -499,63 +1828,9 @@ def main_onchain(dat: FlightData):
 
     Scaling: total_cost is multiplied by 1e18 and truncated to int.
     """
-    # === Identical logic to /optimum_ef_route ===
-    n = dat.grid_density
-    lons = np.linspace(dat.start_long, dat.end_long, n)
-    lats = np.linspace(dat.start_lat, dat.end_lat, n)
-
-    lat_spread = abs(dat.end_lat - dat.start_lat) * 0.5
-    grid = {}
-    coords_list = []
-
-    for i in range(n):
-        center_lat = lats[i]
-        lat_options = np.linspace(center_lat - lat_spread, center_lat + lat_spread, n)
-        for j in range(n):
-            grid[(i, j)] = (lons[i], lat_options[j])
-            coords_list.append((i, j))
-
-    edges = []
-    for i in range(n - 1):
-        for j1 in range(n):
-            for j2 in range(n):
-                edges.append(((i, j1), (i + 1, j2), 1.0))
-
-    altitude_ft = 35000
-    aircraft_type = "A320"
-
-    ef_cache = {}
-    for (a, b, _) in edges:
-        lon_a, lat_a = grid[a]
-        lon_b, lat_b = grid[b]
-        try:
-            ef_values = compute_ef(
-                start_time=dat.start_time,
-                duration_hours=dat.duration_hours,
-                longs=[lon_a, lon_b],
-                lats=[lat_a, lat_b],
-                altitude_ft=altitude_ft,
-                aircraft_type=aircraft_type,
-            )
-            ef_cache[(a, b)] = sum(ef_values) if ef_values else 0.0
-        except Exception:
-            ef_cache[(a, b)] = 0.0
-
-    def cost_fn(coord_from, coord_to):
-        lon_a, lat_a = grid[coord_from]
-        lon_b, lat_b = grid[coord_to]
-        dlat = np.radians(lat_b - lat_a)
-        dlon = np.radians(lon_b - lon_a)
-        a_h = np.sin(dlat / 2) ** 2 + np.cos(np.radians(lat_a)) * np.cos(np.radians(lat_b)) * np.sin(dlon / 2) ** 2
-        dist_km = 6371 * 2 * np.arctan2(np.sqrt(a_h), np.sqrt(1 - a_h))
-        fuel_cost = dat.fuel_cost_per_km * dist_km
-        ef_cost = dat.lambda_value * ef_cache.get((coord_from, coord_to), 0.0)
-        return fuel_cost + ef_cost
-
-    start_node = (0, n // 2)
-    end_node = (n - 1, n // 2)
-
-    total_cost, path = dijkstra(edges, start_node, end_node, cost_fn)
+    # === Same route as /optimum_ef_route, shared through the route cache ===
+    result = route_service.get(dat)
+    total_cost, path = result.total_cost, result.path
 
     # === Different from /optimum_ef_route: return scaled integers ===
     COST_SCALE = 10**10
@@ -565,8 +1840,3 @@ def main_onchain(dat: FlightData):
         "num_nodes": int(len(path)),
         "num_waypoints": int(len(path)),
     }
-
->>>>>>> dc1c73f (Add contrail API code)
-
-
-
@@ -0,0 +1,128 @@
+"""
+Persistent on-disk cache of ERA5 met/rad slices for the contrail API.
+
+Each slice is stored as one NetCDF file under a cache directory, keyed by
+time window, pressure levels, variable set and lon/lat box. The directory is kept under
+a total byte budget by evicting the least recently used files first (file
+mtime is bumped on every hit).
+
+A cache directory seeded by an online run can be copied to another host and
+used with MET_CACHE_OFFLINE=1, in which case a miss raises instead of
+downloading from CDS.
+"""
+import hashlib
+import json
+import os
+import uuid
+
+import xarray as xr
+
+MET_CACHE_DIR = os.getenv(
+    "MET_CACHE_DIR", os.path.expanduser("~/.cache/contrail_api/met")
+)
+MET_CACHE_MAX_BYTES = int(os.getenv("MET_CACHE_MAX_BYTES", str(20 * 1024 ** 3)))
+MET_CACHE_OFFLINE = os.getenv("MET_CACHE_OFFLINE", "0") == "1"
+
+
+class MetCacheMiss(LookupError):
+    """Raised when an offline cache does not hold the requested slice."""
+
+
+def _variable_name(variable):
+    # Model variable lists may hold tuples of interchangeable alternatives
+    if isinstance(variable, (tuple, list)):
+        return "|".join(_variable_name(v) for v in variable)
+    return getattr(variable, "short_name", variable)
+
+
+def cache_key(start_time, end_time, pressure_levels, variables, bbox=None):
+    """Return a stable file key for a met slice.
+
+    ``variables`` may be pycontrails MetVariables or plain short names.
+    ``pressure_levels`` is None for single-level (rad) slices, and ``bbox``
+    ``(lon_min, lon_max, lat_min, lat_max)`` is None for global ones.
+    """
+    payload = {
+        "start_time": start_time.isoformat(),
+        "end_time": end_time.isoformat(),
+        "pressure_levels": sorted(pressure_levels) if pressure_levels else None,
+        "variables": sorted(_variable_name(v) for v in variables),
+    }
+    # Left out for global slices so existing cache entries keep their keys
+    if bbox is not None:
+        payload["bbox"] = [float(v) for v in bbox]
+    payload = json.dumps(payload, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+
+class MetCache:
+    """Directory of NetCDF met slices with an LRU total-size cap."""
+
+    def __init__(self, directory=MET_CACHE_DIR, max_bytes=MET_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.nc")
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        """Return the cached xarray Dataset for ``key`` loaded into memory, or None."""
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        with xr.open_dataset(path) as ds:
+            return ds.load()
+
+    def put(self, key, ds):
+        """Write ``ds`` under ``key`` and evict old entries to stay within budget."""
+        path = self.path(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            ds.to_netcdf(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict(keep=key)
+
+    def entries(self):
+        """Return (mtime, size, key) for every cached slice, oldest first."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".nc"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name[:-3]))
+        entries.sort()
+        return entries
+
+    def total_bytes(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep=None):
+        """Delete least recently used slices until the cache fits in max_bytes.
+
+        The entry named by ``keep`` (normally the one just written) is never
+        evicted, even if it alone exceeds the budget.
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,101 @@
+"""
+Prometheus metrics for the contrail API.
+
+Everything is registered on the default prometheus_client registry and
+served by the /metrics endpoint. EF pool workers run in other processes, so
+their failure counts are sent back with each batch and recorded here in the
+API process.
+"""
+import time
+
+from prometheus_client import Counter, Histogram
+
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "contrail_http_request_duration_seconds",
+    "HTTP request latency by route template and status code.",
+    ["method", "route", "status"],
+    buckets=STAGE_BUCKETS,
+)
+ROUTE_STAGE_SECONDS = Histogram(
+    "contrail_route_stage_seconds",
+    "Time spent in each route computation stage (grid, met, ef, search).",
+    ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+ROUTE_CACHE_LOOKUPS = Counter(
+    "contrail_route_cache_lookups_total",
+    "Route cache lookups by result (hit, miss, coalesced).",
+    ["result"],
+)
+EF_SEGMENTS = Counter(
+    "contrail_ef_segments_total",
+    "Segment EF values produced, by source (cocip, store, field, interpolated, reused, surrogate).",
+    ["source"],
+)
+EF_STORE_LOOKUPS = Counter(
+    "contrail_ef_store_lookups_total",
+    "Segment EF store lookups by result (hit, miss).",
+    ["result"],
+)
+EF_FAILURES = Counter(
+    "contrail_ef_failures_total",
+    "EF evaluations that failed: a batched CoCiP run that fell back to per-segment runs "
+    "(batch), a segment set to 0.0 (segment), or a worker batch set to 0.0 (worker).",
+    ["kind"],
+)
+SURROGATE_RELATIVE_ERROR = Histogram(
+    "contrail_surrogate_relative_error",
+    "|surrogate - exact| / |exact| route cost of the route chosen in surrogate EF mode.",
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10),
+)
+SEARCH_NODES_EXPANDED = Counter(
+    "contrail_search_nodes_expanded_total",
+    "Nodes expanded by the route solvers.",
+    ["solver"],
+)
+SEARCH_EDGES_RELAXED = Counter(
+    "contrail_search_edges_relaxed_total",
+    "Edges relaxed by the route solvers.",
+    ["solver"],
+)
+SEARCH_HEAP_OPERATIONS = Counter(
+    "contrail_search_heap_operations_total",
+    "Priority queue pushes, decrease-keys and pops made by the route solvers.",
+    ["solver"],
+)
+
+
+def record_ef_failures(failures):
+    """Add a ``{kind: count}`` dict from compute_ef_batch to EF_FAILURES."""
+    for kind, count in failures.items():
+        if count:
+            EF_FAILURES.labels(kind).inc(count)
+
+
+class StageClock:
+    """Moves ``progress["stage"]`` through named stages and times each one.
+
+    Entering a new stage observes how long the previous one took; entering
+    the current stage again does nothing.
+    """
+
+    def __init__(self, progress, histogram=ROUTE_STAGE_SECONDS):
+        self.progress = progress
+        self.histogram = histogram
+        self.stage = None
+        self.started = None
+
+    def enter(self, stage):
+        if stage == self.stage:
+            return
+        now = time.perf_counter()
+        if self.stage is not None:
+            self.histogram.labels(self.stage).observe(now - self.started)
+        self.stage = stage
+        self.started = now
+        self.progress["stage"] = stage
+
+    def finish(self):
+        self.enter("done")
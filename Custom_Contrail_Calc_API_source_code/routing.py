@@ -0,0 +1,791 @@
+"""
+Graph search for the contrail route optimiser.
+
+Kept free of pycontrails/ERA5 imports so the solvers can be exercised and
+benchmarked offline.
+"""
+import bisect
+from array import array
+
+import numpy as np
+
+
+class IndexedMinHeap:
+    """Indexed binary min-heap over dense integer node IDs ``0..capacity-1``.
+
+    The heap, the position index and the values live in flat ``array``
+    buffers rather than Python lists and tuple-keyed dicts. Sifting moves a
+    hole rather than swapping, so each level costs two buffer writes.
+    """
+
+    def __init__(self, capacity):
+        self._heap = array('l')                        # heap slot -> node id
+        self._pos = array('l', [-1]) * capacity        # node id -> heap slot, -1 if absent
+        self._values = array('d', [0.0]) * capacity    # node id -> current value
+
+    def _sift_up(self, i):
+        heap, pos, values = self._heap, self._pos, self._values
+        node = heap[i]
+        value = values[node]
+        while i > 0:
+            parent = (i - 1) >> 1
+            parent_node = heap[parent]
+            if value < values[parent_node]:
+                heap[i] = parent_node
+                pos[parent_node] = i
+                i = parent
+            else:
+                break
+        heap[i] = node
+        pos[node] = i
+
+    def _sift_down(self, i):
+        heap, pos, values = self._heap, self._pos, self._values
+        n = len(heap)
+        node = heap[i]
+        value = values[node]
+        while True:
+            child = 2 * i + 1
+            if child >= n:
+                break
+            right = child + 1
+            if right < n and values[heap[right]] < values[heap[child]]:
+                child = right
+            child_node = heap[child]
+            if values[child_node] < value:
+                heap[i] = child_node
+                pos[child_node] = i
+                i = child
+            else:
+                break
+        heap[i] = node
+        pos[node] = i
+
+    def enqueue(self, node, value):
+        """Insert a node ID with an associated value."""
+        if self._pos[node] >= 0:
+            raise ValueError(f"{node} already in queue. Use decrease_value() instead.")
+        self._values[node] = value
+        self._heap.append(node)
+        self._sift_up(len(self._heap) - 1)
+
+    def dequeue_min(self):
+        """Remove and return (node, value) with the smallest value."""
+        heap = self._heap
+        if not heap:
+            raise IndexError("dequeue from empty queue")
+        node = heap[0]
+        last = heap.pop()
+        self._pos[node] = -1
+        if heap:
+            heap[0] = last
+            self._sift_down(0)
+        return node, self._values[node]
+
+    def decrease_value(self, node, new_value):
+        """Decrease the value associated with a node ID.
+
+        Raises ValueError if new_value is not strictly less than current value.
+        """
+        idx = self._pos[node]
+        if idx < 0:
+            raise KeyError(f"{node} not found in queue")
+        old_value = self._values[node]
+        if new_value >= old_value:
+            raise ValueError(f"New value {new_value} must be less than current value {old_value}")
+        self._values[node] = new_value
+        self._sift_up(idx)
+
+    def peek_min(self):
+        """Return (node, value) with the smallest value without removing it."""
+        if not self._heap:
+            raise IndexError("peek from empty queue")
+        node = self._heap[0]
+        return node, self._values[node]
+
+    def get_value(self, node):
+        """Return the current value associated with a node ID."""
+        if not 0 <= node < len(self._pos) or self._pos[node] < 0:
+            raise KeyError(node)
+        return self._values[node]
+
+    def __contains__(self, node):
+        return 0 <= node < len(self._pos) and self._pos[node] >= 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __bool__(self):
+        return bool(self._heap)
+
+    def __repr__(self):
+        items = [(node, self._values[node]) for node in self._heap]
+        return f"IndexedMinHeap({items})"
+
+
+def _search(
+        num_nodes, successors, start_id, end_id, edge_cost, max_expansions=None,
+        heuristic=None, stats=None, upper_bound=None, lower_bound=None,
+):
+    """Search loop behind grid_dijkstra, on integer node ids.
+
+    ``successors(u)`` returns ``(targets, v_base, k_base)``: the r-th
+    successor of u is node ``v_base + targets[r]`` via edge ``k_base + r``.
+    ``edge_cost(u, v, k)`` prices that edge. Returns ``(cost, path_ids)``.
+    """
+    if stats is not None:
+        stats.update(nodes_expanded=0, edges_relaxed=0, heap_operations=0)
+
+    if heuristic is None:
+        estimate = None
+    else:
+        estimate = array('d', [float('nan')]) * num_nodes
+
+    if lower_bound is None:
+        lower_bound = heuristic
+    if upper_bound is not None and lower_bound is not None:
+        bound = array('d', [float('nan')]) * num_nodes
+    else:
+        bound = None
+    pruned = 0
+
+    pq = IndexedMinHeap(num_nodes)
+    dist = array('d', [float('inf')]) * num_nodes
+    prev = array('l', [-1]) * num_nodes
+    dist[start_id] = 0.0
+
+    pq.enqueue(start_id, 0.0 if estimate is None else heuristic(start_id))
+    expansions = 0
+    relaxed = 0
+    heap_operations = 1
+
+    while pq:
+        current, _priority = pq.dequeue_min()
+        current_dist = dist[current]
+        heap_operations += 1
+
+        # Early exit
+        if current == end_id:
+            break
+
+        # Search budget
+        expansions += 1
+        if stats is not None:
+            stats["nodes_expanded"] = expansions
+        if max_expansions is not None and expansions > max_expansions:
+            if stats is not None:
+                stats.update(
+                    nodes_expanded=expansions - 1, edges_relaxed=relaxed,
+                    heap_operations=heap_operations,
+                )
+            return float('inf'), []
+
+        targets, v_base, k_base = successors(current)
+        for r, target in enumerate(targets):
+            neighbor = v_base + target
+            # Use custom cost function instead of (or in addition to) edge weight
+            new_dist = current_dist + edge_cost(current, neighbor, k_base + r)
+            relaxed += 1
+
+            if new_dist < dist[neighbor]:
+                if upper_bound is not None:
+                    remaining = 0.0
+                    if bound is not None:
+                        if bound[neighbor] != bound[neighbor]:
+                            bound[neighbor] = lower_bound(neighbor)
+                        remaining = bound[neighbor]
+                    if new_dist + remaining > upper_bound:
+                        pruned += 1
+                        continue
+
+                dist[neighbor] = new_dist
+                prev[neighbor] = current
+
+                priority = new_dist
+                if estimate is not None:
+                    if estimate[neighbor] != estimate[neighbor]:  # NaN: not computed yet
+                        estimate[neighbor] = heuristic(neighbor)
+                    priority += estimate[neighbor]
+
+                if neighbor in pq:
+                    pq.decrease_value(neighbor, priority)
+                else:
+                    pq.enqueue(neighbor, priority)
+                heap_operations += 1
+
+    if stats is not None:
+        stats.update(
+            nodes_expanded=expansions, edges_relaxed=relaxed, heap_operations=heap_operations,
+        )
+        if upper_bound is not None:
+            stats["nodes_pruned"] = pruned
+
+    # Reconstruct path
+    if end_id < 0 or dist[end_id] == float('inf'):
+        return float('inf'), []
+
+    path = []
+    node = end_id
+    while node >= 0:
+        path.append(node)
+        node = prev[node]
+    path.reverse()
+
+    return dist[end_id], path
+
+
+EARTH_RADIUS_KM = 6371
+
+
+def haversine_km(lon_a, lat_a, lon_b, lat_b):
+    """Great-circle distance in km; broadcasts over NumPy arrays."""
+    lat_a = np.radians(lat_a)
+    lat_b = np.radians(lat_b)
+    dlat = lat_b - lat_a
+    dlon = np.radians(np.subtract(lon_b, lon_a))
+    a_h = np.sin(dlat / 2) ** 2 + np.cos(lat_a) * np.cos(lat_b) * np.sin(dlon / 2) ** 2
+    return EARTH_RADIUS_KM * 2 * np.arctan2(np.sqrt(a_h), np.sqrt(1 - a_h))
+
+
+def layer_distances_km(col_lons, col_lats):
+    """Distances for every column-to-column edge of a layered grid.
+
+    ``col_lons`` has shape (n_cols,) and ``col_lats`` shape (n_cols, n_rows).
+    Returns an (n_cols - 1, n_rows, n_rows) array where ``[i, j1, j2]`` is the
+    distance from node (i, j1) to node (i + 1, j2).
+    """
+    col_lons = np.asarray(col_lons, dtype=float)
+    col_lats = np.asarray(col_lats, dtype=float)
+    return haversine_km(
+        col_lons[:-1, None, None], col_lats[:-1, :, None],
+        col_lons[1:, None, None], col_lats[1:, None, :],
+    )
+
+
+class RouteGrid:
+    """Layered 3D waypoint grid between an origin and a destination.
+
+    Column i is one step along track at longitude ``col_lons[i]``. Each column
+    holds ``n_rows`` lateral options (``col_lats[i]``) at every flight level in
+    ``altitudes_ft``. A node is ``(i, s)``, where the state ``s = k * n_rows + j``
+    combines lateral row j and flight level k. Every solver can therefore treat
+    the grid as a column-to-column graph with ``n_states`` nodes per column.
+    Edges join each state of column i to every state of column i + 1 whose
+    flight level differs by at most ``max_level_change`` levels and, if
+    ``max_lateral_change`` is set, whose lateral row differs by at most that
+    many rows.
+    """
+
+    def __init__(
+            self, col_lons, col_lats, altitudes_ft=(35000,), max_level_change=1,
+            max_lateral_change=None,
+    ):
+        self.col_lons = np.asarray(col_lons, dtype=float)
+        self.col_lats = np.asarray(col_lats, dtype=float)
+        self.altitudes_ft = np.asarray(altitudes_ft, dtype=float)
+        self.max_level_change = max_level_change
+        self.max_lateral_change = max_lateral_change
+
+        self.n_cols, self.n_rows = self.col_lats.shape
+        self.n_levels = len(self.altitudes_ft)
+        self.n_states = self.n_rows * self.n_levels
+
+        states = np.arange(self.n_states)
+        self.state_rows = states % self.n_rows
+        self.state_levels = states // self.n_rows
+        # [s1, s2] -> whether a segment may go from state s1 to state s2
+        self.transitions = (
+            np.abs(self.state_levels[:, None] - self.state_levels[None, :])
+            <= max_level_change
+        )
+        if max_lateral_change is not None:
+            self.transitions &= (
+                np.abs(self.state_rows[:, None] - self.state_rows[None, :])
+                <= max_lateral_change
+            )
+
+    @classmethod
+    def between(
+            cls, start_lon, start_lat, end_lon, end_lat, grid_density,
+            altitudes_ft=(35000,), lat_step_deg=None, lon_step_deg=None,
+            max_lateral_change=None,
+    ):
+        """Grid spanning start to end.
+
+        Columns and lateral rows are ``grid_density`` each, unless
+        ``lon_step_deg`` / ``lat_step_deg`` set the spacing instead.
+        """
+        if lon_step_deg:
+            n_cols = max(2, int(np.ceil(abs(end_lon - start_lon) / lon_step_deg)) + 1)
+        else:
+            n_cols = grid_density
+        lons = np.linspace(start_lon, end_lon, n_cols)
+        lats = np.linspace(start_lat, end_lat, n_cols)
+
+        # We allow lateral deviation: for each longitude step, we have multiple latitude options
+        lat_spread = abs(end_lat - start_lat) * 0.5
+        if lat_step_deg:
+            half = int(lat_spread // lat_step_deg)
+            col_lats = lats[:, None] + np.arange(-half, half + 1)[None, :] * lat_step_deg
+        else:
+            col_lats = np.linspace(lats - lat_spread, lats + lat_spread, grid_density, axis=1)
+
+        return cls(lons, col_lats, sorted(altitudes_ft), max_lateral_change=max_lateral_change)
+
+    def state(self, row, level):
+        return level * self.n_rows + row
+
+    @property
+    def start_node(self):
+        """Centre row at the middle flight level of the first column."""
+        return (0, self.state(self.n_rows // 2, self.n_levels // 2))
+
+    @property
+    def end_node(self):
+        return (self.n_cols - 1, self.state(self.n_rows // 2, self.n_levels // 2))
+
+    def position(self, node):
+        """Return (lon, lat, altitude_ft) of a node."""
+        i, s = node
+        return (
+            float(self.col_lons[i]),
+            float(self.col_lats[i, self.state_rows[s]]),
+            float(self.altitudes_ft[self.state_levels[s]]),
+        )
+
+    def edge_index(self):
+        """Arrays (i, s1, s2) of every allowed edge, in lexicographic order."""
+        allowed = np.broadcast_to(self.transitions, (self.n_cols - 1, self.n_states, self.n_states))
+        return np.nonzero(allowed)
+
+    def edges(self):
+        """Allowed edges as ``((i, s1), (i + 1, s2), 1.0)`` tuples for dijkstra."""
+        cols, s_from, s_to = self.edge_index()
+        return [
+            ((i, a), (i + 1, b), 1.0)
+            for i, a, b in zip(cols.tolist(), s_from.tolist(), s_to.tolist())
+        ]
+
+    def segments(self):
+        """Endpoints ``((lon, lat, alt), (lon, lat, alt))`` of every allowed edge, in edge order."""
+        cols, s_from, s_to = self.edge_index()
+        lons_a = self.col_lons[cols]
+        lons_b = self.col_lons[cols + 1]
+        lats_a = self.col_lats[cols, self.state_rows[s_from]]
+        lats_b = self.col_lats[cols + 1, self.state_rows[s_to]]
+        alts_a = self.altitudes_ft[self.state_levels[s_from]]
+        alts_b = self.altitudes_ft[self.state_levels[s_to]]
+        return list(zip(
+            zip(lons_a.tolist(), lats_a.tolist(), alts_a.tolist()),
+            zip(lons_b.tolist(), lats_b.tolist(), alts_b.tolist()),
+        ))
+
+    def segment(self, i, s_from, s_to):
+        """Endpoints ``((lon, lat, alt), (lon, lat, alt))`` of edge (i, s_from) -> (i + 1, s_to)."""
+        return self.position((i, s_from)), self.position((i + 1, s_to))
+
+    def scatter(self, edge_values, fill=0.0):
+        """Place per-edge values (in edge order) into an (n_cols - 1, n_states, n_states) array."""
+        out = np.full((self.n_cols - 1, self.n_states, self.n_states), fill, dtype=float)
+        out[self.edge_index()] = edge_values
+        return out
+
+    def mask_disallowed(self, layer_costs):
+        """Set the cost of edges that change level too steeply to infinity."""
+        return np.where(self.transitions, layer_costs, np.inf)
+
+    def graph(self):
+        """Implicit forward-only GridGraph over this grid's allowed edges."""
+        return GridGraph(self.n_cols, self.transitions)
+
+    def edge_distances_km(self):
+        """Horizontal distance of every allowed edge, in edge order."""
+        cols, s_from, s_to = self.edge_index()
+        return haversine_km(
+            self.col_lons[cols], self.col_lats[cols, self.state_rows[s_from]],
+            self.col_lons[cols + 1], self.col_lats[cols + 1, self.state_rows[s_to]],
+        )
+
+    def layer_distances_km(self):
+        """Horizontal distance of every (i, s1) -> (i + 1, s2) pair."""
+        return layer_distances_km(self.col_lons, self.col_lats[:, self.state_rows])
+
+    def distances_to_end_km(self):
+        """Great-circle distance from every node (i, s) to the end node, as (n_cols, n_states)."""
+        end_lon, end_lat, _ = self.position(self.end_node)
+        return haversine_km(
+            self.col_lons[:, None], self.col_lats[:, self.state_rows], end_lon, end_lat
+        )
+
+    def waypoints(self, path):
+        waypoints = []
+        for node in path:
+            lon, lat, alt = self.position(node)
+            waypoints.append({"longitude": lon, "latitude": lat, "altitude_ft": alt})
+        return waypoints
+
+    def subgrid(self, rows, max_lateral_change=None):
+        """Grid over the same columns and flight levels keeping rows ``rows[i]`` of column i.
+
+        ``rows`` is an (n_cols, k) array of ascending row indices. Edges keep
+        this grid's level limit; ``max_lateral_change`` counts rows of the new grid.
+        """
+        col_lats = np.take_along_axis(self.col_lats, np.asarray(rows), axis=1)
+        return RouteGrid(
+            self.col_lons, col_lats, self.altitudes_ft,
+            max_level_change=self.max_level_change, max_lateral_change=max_lateral_change,
+        )
+
+
+def corridor_rows(n_rows, centres, stride, half_width):
+    """Row indices of a corridor: ``centre + k * stride`` for ``|k| <= half_width``.
+
+    ``centres`` holds one row per column. The half width is capped so the
+    middle row ``n_rows // 2`` fits, and each column's window is shifted by
+    whole strides to stay inside the grid, keeping rows on the same lattice
+    as the centre. Returns an (n_cols, 2 * half_width + 1) array.
+    """
+    mid = n_rows // 2
+    half_width = min(half_width, mid // stride, (n_rows - 1 - mid) // stride)
+    reach = half_width * stride
+    centres = np.asarray(centres, dtype=int)
+    centres = centres + stride * np.ceil(np.maximum(reach - centres, 0) / stride).astype(int)
+    centres = centres - stride * np.ceil(
+        np.maximum(centres + reach - (n_rows - 1), 0) / stride
+    ).astype(int)
+    return centres[:, None] + stride * np.arange(-half_width, half_width + 1)[None, :]
+
+
+class GridGraph:
+    """Forward edges of a RouteGrid, generated on demand from its transitions.
+
+    Node ``(i, s)`` has id ``i * n_states + s`` and its successors are the
+    allowed states of column i + 1. Edge ids follow RouteGrid.edge_index
+    order, so per-edge arrays such as EF from ``grid.segments()`` index
+    straight in. Only per-state target lists are stored, O(n_states^2) in
+    total however many columns there are, and there are no backward edges.
+    """
+
+    def __init__(self, n_cols, transitions):
+        transitions = np.asarray(transitions, dtype=bool)
+        self.n_cols = n_cols
+        self.n_states = transitions.shape[0]
+        self.num_nodes = n_cols * self.n_states
+        self.targets = [np.nonzero(row)[0].tolist() for row in transitions]
+        counts = transitions.sum(axis=1)
+        # First edge id of each state within a layer
+        self.edge_base = np.concatenate(([0], np.cumsum(counts)[:-1])).tolist()
+        self.edges_per_layer = int(counts.sum())
+        self.num_edges = (n_cols - 1) * self.edges_per_layer
+
+    def node_id(self, node):
+        i, s = node
+        return i * self.n_states + s
+
+    def node(self, node_id):
+        return divmod(node_id, self.n_states)
+
+    def successors(self, node_id):
+        i, s = divmod(node_id, self.n_states)
+        if i >= self.n_cols - 1:
+            return (), 0, 0
+        return (
+            self.targets[s],
+            (i + 1) * self.n_states,
+            i * self.edges_per_layer + self.edge_base[s],
+        )
+
+    def edge_id(self, node_from, node_to):
+        i, s1 = node_from
+        _, s2 = node_to
+        return i * self.edges_per_layer + self.edge_base[s1] + self.targets[s1].index(s2)
+
+    def path_cost(self, path, weights):
+        """Sum ``weights[edge_id]`` along a path, in the order the search adds them."""
+        total = 0.0
+        for node_from, node_to in zip(path, path[1:]):
+            total += weights[self.edge_id(node_from, node_to)]
+        return total
+
+
+def grid_dijkstra(graph, start, end, edge_cost, heuristic=None, lower_bound=None, **kwargs):
+    """dijkstra (or A* with ``heuristic``) over a GridGraph.
+
+    ``edge_cost(u, v, k)`` receives node ids and the edge id. ``heuristic``
+    and ``lower_bound`` take ``(i, s)`` nodes, like great_circle_heuristic.
+    Returns ``(cost, path)`` with path as ``(i, s)`` nodes.
+
+    ``max_expansions`` caps the number of nodes taken off the queue; if the
+    budget runs out before end is reached, no route is returned.
+
+    With a ``heuristic(node)`` giving a lower bound on the remaining cost to
+    end, the queue is ordered by cost-so-far + heuristic (A*). Nodes whose
+    cost later improves are re-queued, so an admissible heuristic still
+    yields the optimal route.
+
+    ``upper_bound`` warm-starts the search with the cost of a known route:
+    a label is not queued if its cost plus ``lower_bound(node)`` (default:
+    the heuristic, or 0) exceeds it, since it cannot lead to a cheaper route.
+
+    If ``stats`` is a dict, it is filled with ``nodes_expanded``,
+    ``edges_relaxed`` and ``heap_operations`` counters, plus ``nodes_pruned``
+    when ``upper_bound`` is set.
+    """
+    node = graph.node
+    total_cost, path = _search(
+        graph.num_nodes, graph.successors, graph.node_id(start), graph.node_id(end), edge_cost,
+        heuristic=None if heuristic is None else (lambda u: heuristic(node(u))),
+        lower_bound=None if lower_bound is None else (lambda u: lower_bound(node(u))),
+        **kwargs,
+    )
+    return total_cost, [node(u) for u in path]
+
+
+def grid_k_shortest(graph, start, end, edge_cost, k, first=None, heuristic=None, lower_bound=None,
+                    stats=None, **kwargs):
+    """Yen's k shortest paths over a GridGraph.
+
+    ``first`` is the already found shortest ``(cost, path)``, reused instead
+    of searching again. Each further path comes from spur searches with
+    grid_dijkstra from every node of the previous path, pricing the edges
+    that accepted paths with the same root take out of that node at
+    infinity. Edges only go forward, so a spur path can never revisit its
+    root and no nodes need removing. ``edge_cost`` is called as is, so a
+    lazy EF cache is shared with the first search. A consistent
+    ``lower_bound`` on the cost to the end, such as great_circle_heuristic,
+    serves as the A* heuristic when ``heuristic`` is not set. It keeps the
+    searches exact with negative edge costs, and once enough candidates are
+    queued each spur search is bounded by the worst one still needed.
+    Without either, nothing is pruned. Other keyword arguments are as for
+    grid_dijkstra. If ``stats`` is a dict, the spur searches' counters are
+    summed into it. Returns up to k ``(cost, path)`` in ascending cost.
+    """
+    if stats is not None:
+        stats.update(nodes_expanded=0, edges_relaxed=0, heap_operations=0, spur_searches=0)
+    if heuristic is None:
+        heuristic = lower_bound
+    if first is None:
+        first = grid_dijkstra(graph, start, end, edge_cost, heuristic=heuristic, **kwargs)
+    if not first[1]:
+        return []
+
+    node_id = graph.node_id
+    accepted = [first]
+    # Candidate paths sorted by cost, and every path seen so far
+    candidates = []
+    seen = {tuple(first[1])}
+
+    while len(accepted) < k:
+        _cost, previous = accepted[-1]
+        root_cost = 0.0
+        for j in range(len(previous) - 1):
+            spur, root = previous[j], previous[:j + 1]
+            banned = {
+                graph.edge_id(path[j], path[j + 1])
+                for _c, path in accepted if path[:j + 1] == root
+            }
+
+            def spur_cost(u, v, e, banned=banned):
+                return float('inf') if e in banned else edge_cost(u, v, e)
+
+            needed = k - len(accepted)
+            upper_bound = None
+            if heuristic is not None and len(candidates) >= needed:
+                upper_bound = candidates[needed - 1][0] - root_cost
+            search_stats = {}
+            spur_total, spur_path = grid_dijkstra(
+                graph, spur, end, spur_cost, heuristic=heuristic, lower_bound=lower_bound,
+                upper_bound=upper_bound, stats=search_stats, **kwargs,
+            )
+            if stats is not None:
+                stats["spur_searches"] += 1
+                for key in ("nodes_expanded", "edges_relaxed", "heap_operations"):
+                    stats[key] += search_stats[key]
+
+            if spur_path:
+                path = root[:-1] + spur_path
+                if tuple(path) not in seen:
+                    seen.add(tuple(path))
+                    bisect.insort(candidates, (root_cost + spur_total, path))
+
+            u, v = previous[j], previous[j + 1]
+            root_cost += edge_cost(node_id(u), node_id(v), graph.edge_id(u, v))
+
+        if not candidates:
+            break
+        accepted.append(candidates.pop(0))
+    # dijkstra is not exact with negative edge costs, so a later path can
+    # come out cheaper than an earlier one
+    return sorted(accepted, key=lambda route: route[0])
+
+
+def flat_cost_fn(weights):
+    """grid_dijkstra edge_cost reading a per-edge weight list in edge order."""
+    weights = np.asarray(weights, dtype=float).tolist()
+
+    def edge_cost(_u, _v, k):
+        return weights[k]
+
+    return edge_cost
+
+
+def lazy_flat_cost_fn(graph, fuel_costs, lambda_value, ef_lookup):
+    """Like flat_cost_fn, but EF comes from ``ef_lookup(i, s1, s2)`` as edges are relaxed."""
+    fuel = np.asarray(fuel_costs, dtype=float).tolist()
+    n_states = graph.n_states
+
+    def edge_cost(u, v, k):
+        i, s1 = divmod(u, n_states)
+        return fuel[k] + lambda_value * ef_lookup(i, s1, v % n_states)
+
+    return edge_cost
+
+
+def great_circle_heuristic(grid, fuel_cost_per_km, lambda_value, ef_lower_bound):
+    """Admissible A* heuristic for a RouteGrid.
+
+    Any route to the end flies at least the great-circle distance, and each
+    remaining segment contributes at least ``lambda_value * ef_lower_bound``
+    of EF cost (EF can be negative). Only a negative bound lowers the
+    estimate, so the heuristic never overestimates for ``lambda_value >= 0``.
+    """
+    remaining_segments = (grid.n_cols - 1 - np.arange(grid.n_cols))[:, None]
+    table = (
+        fuel_cost_per_km * grid.distances_to_end_km()
+        + min(lambda_value * ef_lower_bound, 0.0) * remaining_segments
+    ).tolist()
+
+    def heuristic(node):
+        return table[node[0]][node[1]]
+
+    return heuristic
+
+
+def solve_layered_dag(layer_costs, start_row, end_row):
+    """Shortest path through a column-to-column layered DAG.
+
+    ``layer_costs[i, j1, j2]`` is the cost of the edge (i, j1) -> (i + 1, j2).
+    Each layer is one vectorised min-plus product of the current distance
+    vector with that layer's cost matrix, so there is no heap and no
+    per-edge Python call. Returns ``(total_cost, path)`` with path as a list
+    of (i, j) nodes from (0, start_row) to (n_layers, end_row), matching
+    dijkstra on the forward edges of the same grid.
+    """
+    layer_costs = np.asarray(layer_costs, dtype=float)
+    num_layers, num_rows, _ = layer_costs.shape
+
+    dist = np.full(num_rows, np.inf)
+    dist[start_row] = 0.0
+    back = np.empty((num_layers, num_rows), dtype=np.intp)
+    rows = np.arange(num_rows)
+
+    for i in range(num_layers):
+        candidates = dist[:, None] + layer_costs[i]
+        back[i] = np.argmin(candidates, axis=0)
+        dist = candidates[back[i], rows]
+
+    total_cost = float(dist[end_row])
+    if not np.isfinite(total_cost):
+        return float('inf'), []
+
+    path = [(num_layers, int(end_row))]
+    row = end_row
+    for i in range(num_layers - 1, -1, -1):
+        row = back[i, row]
+        path.append((i, int(row)))
+    path.reverse()
+
+    return total_cost, path
+
+
+def solve_layered_dag_sweep(fuel_costs, ef_costs, lambda_values, start_row, end_row):
+    """solve_layered_dag for many trade-off weights at once.
+
+    Layer costs are ``fuel_costs + lambda * ef_costs``, built one layer at a
+    time for every lambda in ``lambda_values`` together, so a whole sweep is
+    one pass of batched min-plus products. ``fuel_costs`` should already be
+    infinite on disallowed edges. Returns a list of ``(total_cost, path)``, one
+    per lambda, each identical to solve_layered_dag on that lambda's costs.
+    """
+    fuel_costs = np.asarray(fuel_costs, dtype=float)
+    ef_costs = np.asarray(ef_costs, dtype=float)
+    lambdas = np.asarray(lambda_values, dtype=float)[:, None, None]
+    num_layers, num_rows, _ = fuel_costs.shape
+    num_lambdas = lambdas.shape[0]
+
+    dist = np.full((num_lambdas, num_rows), np.inf)
+    dist[:, start_row] = 0.0
+    back = np.empty((num_layers, num_lambdas, num_rows), dtype=np.intp)
+    sweep = np.arange(num_lambdas)[:, None]
+    rows = np.arange(num_rows)[None, :]
+
+    for i in range(num_layers):
+        candidates = dist[:, :, None] + (fuel_costs[i] + lambdas * ef_costs[i])
+        back[i] = np.argmin(candidates, axis=1)
+        dist = candidates[sweep, back[i], rows]
+
+    results = []
+    for k in range(num_lambdas):
+        total_cost = float(dist[k, end_row])
+        if not np.isfinite(total_cost):
+            results.append((float('inf'), []))
+            continue
+        path = [(num_layers, int(end_row))]
+        row = end_row
+        for i in range(num_layers - 1, -1, -1):
+            row = back[i, k, row]
+            path.append((i, int(row)))
+        path.reverse()
+        results.append((total_cost, path))
+    return results
+
+
+def solve_layered_dag_kbest(layer_costs, start_row, end_row, k):
+    """The ``k`` cheapest distinct paths through a layered DAG.
+
+    Like solve_layered_dag, but every node keeps its k best labels, each
+    remembering the (row, rank) label it extends. A layer is then one
+    vectorised partial sort over all (predecessor, rank) candidates of every
+    node. Returns up to k ``(total_cost, path)`` pairs in ascending cost,
+    fewer if the DAG has fewer paths from start to end.
+    """
+    layer_costs = np.asarray(layer_costs, dtype=float)
+    num_layers, num_rows, _ = layer_costs.shape
+
+    dist = np.full((num_rows, k), np.inf)
+    dist[start_row, 0] = 0.0
+    back_rows = np.empty((num_layers, num_rows, k), dtype=np.intp)
+    back_ranks = np.empty((num_layers, num_rows, k), dtype=np.intp)
+
+    for i in range(num_layers):
+        # (row_from * k + rank, row_to)
+        candidates = (dist[:, :, None] + layer_costs[i][:, None, :]).reshape(num_rows * k, num_rows)
+        best = np.argpartition(candidates, k - 1, axis=0)[:k]
+        best = np.take_along_axis(best, np.argsort(
+            np.take_along_axis(candidates, best, axis=0), axis=0, kind="stable"
+        ), axis=0)
+        dist = np.take_along_axis(candidates, best, axis=0).T
+        back_rows[i] = (best // k).T
+        back_ranks[i] = (best % k).T
+
+    results = []
+    for rank in range(k):
+        total_cost = float(dist[end_row, rank])
+        if not np.isfinite(total_cost):
+            break
+        path = [(num_layers, int(end_row))]
+        row = end_row
+        for i in range(num_layers - 1, -1, -1):
+            row, rank = back_rows[i, row, rank], back_ranks[i, row, rank]
+            path.append((i, int(row)))
+        path.reverse()
+        results.append((total_cost, path))
+    return results
+
+
+def path_layer_sums(path, layer_costs):
+    """Sum ``layer_costs[i, j1, j2]`` over the forward steps of a path of (i, j) nodes."""
+    total = 0.0
+    for (i_a, j_a), (_i_b, j_b) in zip(path, path[1:]):
+        total += float(layer_costs[i_a, j_a, j_b])
+    return total
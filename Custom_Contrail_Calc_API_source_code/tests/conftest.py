@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The API modules are imported by name, as the app runs from this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
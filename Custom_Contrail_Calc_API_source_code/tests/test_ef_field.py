@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from ef_field import EFField, epoch_seconds
+
+START = datetime(2026, 2, 7, 12)
+AIRCRAFT_TYPE = "A320"
+DURATION_HOURS = 2.0
+
+
+def linear_field():
+    times = [epoch_seconds(START + timedelta(hours=h)) for h in range(3)]
+    altitudes_ft = [33000.0, 35000.0, 37000.0]
+    lats = np.arange(48.0, 53.0)
+    lons = np.arange(-2.0, 4.0)
+    t, alt, lat, lon = np.meshgrid(times, altitudes_ft, lats, lons, indexing="ij")
+    values = linear_ef(t, alt, lat, lon)
+    return EFField("linear", times, altitudes_ft, lats, lons, values, AIRCRAFT_TYPE, DURATION_HOURS)
+
+
+def linear_ef(t, alt, lat, lon):
+    return 1e6 * (t - epoch_seconds(START)) / 3600.0 + 2e3 * alt + 5e6 * lat - 3e6 * lon
+
+
+def test_interpolate_is_exact_on_linear_field():
+    field = linear_field()
+    rng = np.random.default_rng(0)
+    n = 200
+    start_time = START + timedelta(minutes=37)
+    altitudes_ft = rng.uniform(33000.0, 37000.0, n)
+    lats = rng.uniform(48.0, 52.0, n)
+    lons = rng.uniform(-2.0, 3.0, n)
+
+    result = field.interpolate(start_time, lons, lats, altitudes_ft)
+
+    expected = linear_ef(epoch_seconds(start_time), altitudes_ft, lats, lons)
+    np.testing.assert_allclose(result, expected, rtol=1e-9)
+
+
+def test_out_of_coverage():
+    field = linear_field()
+
+    assert field.covers(START, [-2.0, 3.0], [48.0, 52.0], [33000.0, 37000.0], AIRCRAFT_TYPE, DURATION_HOURS)
+    assert not field.covers(START, [-2.5, 3.0], [48.0, 52.0], [35000.0], AIRCRAFT_TYPE, DURATION_HOURS)
+    assert not field.covers(START, [0.0], [52.5], [35000.0], AIRCRAFT_TYPE, DURATION_HOURS)
+    assert not field.covers(START, [0.0], [50.0], [39000.0], AIRCRAFT_TYPE, DURATION_HOURS)
+    assert not field.covers(START - timedelta(hours=1), [0.0], [50.0], [35000.0], AIRCRAFT_TYPE, DURATION_HOURS)
+    assert not field.covers(START, [0.0], [50.0], [35000.0], "B738", DURATION_HOURS)
+    assert not field.covers(START, [0.0], [50.0], [35000.0], AIRCRAFT_TYPE, 3.0)
+
+    # Outside the lattice interpolate extrapolates from the edge cells, which
+    # is why routes only use a field that covers them
+    lons, lats, altitudes_ft = [5.0, -4.0], [50.0, 47.0], [35000.0, 38000.0]
+    result = field.interpolate(START, lons, lats, altitudes_ft)
+    expected = linear_ef(epoch_seconds(START), np.array(altitudes_ft), np.array(lats), np.array(lons))
+    assert result == pytest.approx(expected)
@@ -0,0 +1,38 @@
+from datetime import datetime
+
+from ef_store import SegmentEFStore
+
+WINDOW_KEY = SegmentEFStore.window_key(
+    "A320", datetime(2026, 2, 7, 12), 2, datetime(2026, 2, 7, 12), datetime(2026, 2, 7, 14),
+    (300, 250, 225, 200), (-15.0, 20.0, 30.0, 65.0),
+)
+SEGMENT = ((-0.45, 51.47, 35000.0), (0.05, 51.2, 37000.0))
+
+
+def test_round_trip_through_sqlite(tmp_path):
+    path = str(tmp_path / "segment_ef.sqlite")
+    store = SegmentEFStore(path)
+    other = ((0.05, 51.2, 37000.0), (0.55, 50.9, 37000.0))
+    keys = [store.key(SEGMENT, WINDOW_KEY), store.key(other, WINDOW_KEY)]
+
+    assert store.get_many(keys) == [None, None]
+    store.put_many(zip(keys, [1.5e8, -2.5e7]))
+    assert store.get_many(keys) == [1.5e8, -2.5e7]
+
+    # A fresh store with an empty memory LRU reads the values back from disk
+    reopened = SegmentEFStore(path)
+    assert reopened.get_many(keys[::-1] + ["missing"]) == [-2.5e7, 1.5e8, None]
+
+
+def test_nearby_segments_share_a_key(tmp_path):
+    store = SegmentEFStore(str(tmp_path / "segment_ef.sqlite"))
+    (lon_a, lat_a, alt_a), end = SEGMENT
+    # Within half a quantum of SEGMENT, so both round to the same lattice point
+    nearby = ((lon_a + 0.0002, lat_a - 0.0003, alt_a), end)
+    apart = ((lon_a + 0.002, lat_a, alt_a), end)
+
+    assert store.key(nearby, WINDOW_KEY) == store.key(SEGMENT, WINDOW_KEY)
+    assert store.key(apart, WINDOW_KEY) != store.key(SEGMENT, WINDOW_KEY)
+
+    store.put_many([(store.key(SEGMENT, WINDOW_KEY), 3.0e8)])
+    assert store.get_many([store.key(nearby, WINDOW_KEY), store.key(apart, WINDOW_KEY)]) == [3.0e8, None]
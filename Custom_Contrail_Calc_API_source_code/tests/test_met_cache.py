@@ -0,0 +1,71 @@
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from met_cache import MetCache, cache_key
+
+
+def synthetic_slice(seed):
+    rng = np.random.default_rng(seed)
+    coords = {
+        "longitude": np.arange(-10.0, 10.5, 0.5),
+        "latitude": np.arange(40.0, 60.5, 0.5),
+        "level": np.array([200.0, 250.0, 300.0]),
+        "time": pd.date_range("2026-02-07T12:00", periods=3, freq="h"),
+    }
+    shape = tuple(len(values) for values in coords.values())
+    dims = tuple(coords)
+    return xr.Dataset(
+        {
+            "air_temperature": (dims, rng.uniform(200.0, 240.0, shape)),
+            "specific_humidity": (dims, rng.uniform(0.0, 4e-4, shape)),
+        },
+        coords=coords,
+    )
+
+
+def test_get_misses_then_hits(tmp_path):
+    cache = MetCache(str(tmp_path))
+    key = cache_key(
+        datetime(2026, 2, 7, 12), datetime(2026, 2, 7, 14), (200, 250, 300),
+        ["air_temperature", "specific_humidity"],
+    )
+
+    assert key not in cache
+    assert cache.get(key) is None
+
+    ds = synthetic_slice(0)
+    cache.put(key, ds)
+
+    assert key in cache
+    xr.testing.assert_identical(cache.get(key), ds)
+
+
+def test_evicts_least_recently_used_by_bytes(tmp_path):
+    cache = MetCache(str(tmp_path))
+    cache.put("a", synthetic_slice(1))
+    cache.put("b", synthetic_slice(2))
+    size = os.path.getsize(cache.path("a"))
+    os.utime(cache.path("a"), (1000, 1000))
+    os.utime(cache.path("b"), (2000, 2000))
+
+    # A hit makes "a" the most recently used, so "b" goes first
+    assert cache.get("a") is not None
+    cache.max_bytes = 2 * size + size // 2
+    cache.put("c", synthetic_slice(3))
+
+    assert "a" in cache and "c" in cache
+    assert "b" not in cache
+    assert cache.total_bytes() <= cache.max_bytes
+
+
+def test_keeps_new_entry_over_budget(tmp_path):
+    cache = MetCache(str(tmp_path), max_bytes=1)
+    cache.put("a", synthetic_slice(1))
+    cache.put("b", synthetic_slice(2))
+
+    assert "a" not in cache
+    assert "b" in cache
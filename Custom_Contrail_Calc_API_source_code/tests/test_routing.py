@@ -0,0 +1,127 @@
+import numpy as np
+import pytest
+
+from routing import (
+    IndexedMinHeap, RouteGrid, flat_cost_fn, great_circle_heuristic, grid_dijkstra, grid_k_shortest,
+    solve_layered_dag, solve_layered_dag_kbest,
+)
+
+FUEL_COST_PER_KM = 0.15
+LAMBDA_VALUE = 1e-8
+
+
+def random_grid(rng, max_lateral_change=None):
+    n_cols, n_rows = int(rng.integers(3, 7)), int(rng.integers(2, 5))
+    col_lats = np.sort(rng.uniform(48.0, 52.0, (n_cols, n_rows)), axis=1)
+    return RouteGrid(
+        np.linspace(-0.5, 2.5, n_cols), col_lats, altitudes_ft=(33000, 35000, 37000),
+        max_lateral_change=max_lateral_change,
+    )
+
+
+def test_indexed_heap_pops_in_value_order():
+    rng = np.random.default_rng(0)
+    values = rng.uniform(-1.0, 1.0, 50)
+    heap = IndexedMinHeap(len(values))
+    for node in rng.permutation(len(values)):
+        heap.enqueue(int(node), float(values[node]))
+
+    popped = [heap.dequeue_min() for _ in range(len(values))]
+
+    assert [value for _node, value in popped] == sorted(values)
+    assert [node for node, _value in popped] == list(np.argsort(values))
+    assert not heap
+
+
+def test_indexed_heap_decrease_key():
+    heap = IndexedMinHeap(4)
+    for node, value in enumerate([4.0, 3.0, 2.0, 1.0]):
+        heap.enqueue(node, value)
+
+    heap.decrease_value(0, 0.5)
+
+    assert heap.peek_min() == (0, 0.5)
+    assert heap.get_value(0) == 0.5
+    with pytest.raises(ValueError):
+        heap.decrease_value(1, 3.0)
+    assert [heap.dequeue_min()[0] for _ in range(4)] == [0, 3, 2, 1]
+    assert 0 not in heap
+    with pytest.raises(KeyError):
+        heap.decrease_value(0, 0.0)
+
+
+def test_indexed_heap_empty():
+    heap = IndexedMinHeap(2)
+
+    with pytest.raises(IndexError):
+        heap.dequeue_min()
+    with pytest.raises(IndexError):
+        heap.peek_min()
+    heap.enqueue(1, 1.0)
+    heap.dequeue_min()
+    with pytest.raises(IndexError):
+        heap.dequeue_min()
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_dag_matches_dijkstra(seed):
+    rng = np.random.default_rng(seed)
+    grid = random_grid(rng, max_lateral_change=None if seed % 2 else 1)
+    graph = grid.graph()
+    # Non-negative EF, so plain dijkstra is exact
+    ef = rng.uniform(0.0, 3e9, graph.num_edges)
+    weights = FUEL_COST_PER_KM * grid.edge_distances_km() + LAMBDA_VALUE * ef
+    layer_costs = grid.mask_disallowed(
+        FUEL_COST_PER_KM * grid.layer_distances_km() + LAMBDA_VALUE * grid.scatter(ef)
+    )
+
+    expected_cost, expected_path = grid_dijkstra(
+        graph, grid.start_node, grid.end_node, flat_cost_fn(weights.tolist())
+    )
+    total_cost, path = solve_layered_dag(layer_costs, grid.start_node[1], grid.end_node[1])
+
+    assert total_cost == pytest.approx(expected_cost)
+    assert path == expected_path
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_k_shortest_matches_dag_kbest_with_negative_ef(seed):
+    rng = np.random.default_rng(seed)
+    grid = random_grid(rng, max_lateral_change=None if seed % 2 else 1)
+    graph = grid.graph()
+    # EF large enough that many edges cost less than nothing
+    ef = rng.normal(0.0, 3e9, graph.num_edges)
+    weights = FUEL_COST_PER_KM * grid.edge_distances_km() + LAMBDA_VALUE * ef
+    layer_costs = grid.mask_disallowed(
+        FUEL_COST_PER_KM * grid.layer_distances_km() + LAMBDA_VALUE * grid.scatter(ef)
+    )
+    k = 5
+
+    expected = solve_layered_dag_kbest(layer_costs, grid.start_node[1], grid.end_node[1], k)
+    lower_bound = great_circle_heuristic(grid, FUEL_COST_PER_KM, LAMBDA_VALUE, ef.min())
+    routes = grid_k_shortest(
+        graph, grid.start_node, grid.end_node, flat_cost_fn(weights.tolist()), k,
+        lower_bound=lower_bound,
+    )
+
+    assert [cost for cost, _path in routes] == pytest.approx([cost for cost, _path in expected])
+    assert len({tuple(path) for _cost, path in routes}) == len(routes)
+    for cost, path in routes:
+        assert graph.path_cost(path, weights.tolist()) == pytest.approx(cost)
+
+
+def test_k_shortest_is_best_first_without_lower_bound():
+    rng = np.random.default_rng(3)
+    grid = random_grid(rng)
+    graph = grid.graph()
+    weights = (
+        FUEL_COST_PER_KM * grid.edge_distances_km()
+        + LAMBDA_VALUE * rng.normal(0.0, 3e9, graph.num_edges)
+    ).tolist()
+    cost_fn = flat_cost_fn(weights)
+    first = grid_dijkstra(graph, grid.start_node, grid.end_node, cost_fn)
+
+    routes = grid_k_shortest(graph, grid.start_node, grid.end_node, cost_fn, 6, first=first)
+
+    costs = [cost for cost, _path in routes]
+    assert costs == sorted(costs)
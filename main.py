@@ -1,13 +1,111 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager, contextmanager
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, Histogram, generate_latest
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 import httpx
+import logging
 import os
 import json
+import time
 
+try:
+    import h2  # noqa: F401  (enables HTTP/2 in httpx)
+    HTTP2_ENABLED = True
+except ImportError:
+    HTTP2_ENABLED = False
 
-app = FastAPI(title="SkyTrace API")
+logger = logging.getLogger(__name__)
+
+
+# One pooled client per upstream, shared by every request
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+
+UPSTREAM_TIMEOUTS = {
+    "anthropic": float(os.getenv("ANTHROPIC_TIMEOUT", "30")),
+    "optimizer": float(os.getenv("OPTIMIZER_TIMEOUT", "120")),
+    "verify": float(os.getenv("VERIFY_TIMEOUT", "30")),
+}
+
+clients = {}
+
+
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "skytrace_http_request_duration_seconds",
+    "Gateway request latency by route template and status code.",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_REQUEST_SECONDS = Histogram(
+    "skytrace_upstream_request_duration_seconds",
+    "Latency of upstream calls by gateway route, upstream and outcome (ok, timeout, error).",
+    ["route", "upstream", "outcome"],
+    buckets=LATENCY_BUCKETS,
+)
+
+
+@contextmanager
+def observe_upstream(route, upstream):
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except httpx.TimeoutException:
+        outcome = "timeout"
+        raise
+    except Exception:
+        outcome = "error"
+        raise
+    finally:
+        UPSTREAM_REQUEST_SECONDS.labels(route, upstream, outcome).observe(
+            time.perf_counter() - start
+        )
+
+
+@asynccontextmanager
+async def lifespan(app):
+    if not HTTP2_ENABLED:
+        logger.warning(
+            "h2 is not installed, so upstream calls fall back to HTTP/1.1. "
+            "Install httpx[http2] to enable HTTP/2."
+        )
+    limits = httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+    for name, timeout in UPSTREAM_TIMEOUTS.items():
+        clients[name] = httpx.AsyncClient(
+            timeout=timeout, limits=limits, http2=HTTP2_ENABLED
+        )
+    yield
+    for client in clients.values():
+        await client.aclose()
+    clients.clear()
+
+
+app = FastAPI(title="SkyTrace API", lifespan=lifespan)
+
+
+@app.middleware("http")
+async def observe_request_latency(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        HTTP_REQUEST_SECONDS.labels(
+            request.method, getattr(route, "path", "unmatched"), str(status)
+        ).observe(time.perf_counter() - start)
 
 
 app.add_middleware(
@@ -34,6 +132,8 @@ class GridConfig(BaseModel):
     lon_step_deg: float = 0.5
     altitudes_ft: list = [30000, 34000, 38000]
     max_expansions: int = 8000
+    max_lateral_change: Optional[int] = None
+    refine_levels: int = 0
 
 
 class OptimizeRequest(BaseModel):
@@ -43,25 +143,39 @@ class OptimizeRequest(BaseModel):
     aircraft_type: str = "B738"
     lambda_value: float = 1.0 
     grid_config: Optional[GridConfig] = None
+    k_routes: int = 1
 
     class Config:
         populate_by_name = True
 
 
+class ParetoOptimizeRequest(OptimizeRequest):
+    lambda_values: Optional[list] = None
+    lambda_min: Optional[float] = None
+    lambda_max: Optional[float] = None
+    lambda_steps: int = 11
+    lambda_spacing: str = "linear"
+
+
 
 @app.get("/health")
 async def health():
     return {"status": "ok", "service": "SkyTrace API"}
 
 
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY", "YOUR_KEY_HERE")
 
 
 @app.post("/api/chat")
 async def chat_proxy(request: ChatRequest):
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.post(
+    with observe_upstream("/api/chat", "anthropic"):
+        response = await clients["anthropic"].post(
             "https://api.anthropic.com/v1/messages",
             headers={
                 "Content-Type": "application/json",
@@ -75,7 +189,7 @@ async def chat_proxy(request: ChatRequest):
                 "messages": request.messages,
             },
         )
-        data = response.json()
+    data = response.json()
 
     text = data.get("content", [{}])[0].get("text", "Sorry, no response.")
     return {"response": text}
@@ -83,8 +197,8 @@ async def chat_proxy(request: ChatRequest):
 
 @app.post("/api/extract-flight")
 async def extract_flight(request: ChatRequest):
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.post(
+    with observe_upstream("/api/extract-flight", "anthropic"):
+        response = await clients["anthropic"].post(
             "https://api.anthropic.com/v1/messages",
             headers={
                 "Content-Type": "application/json",
@@ -98,7 +212,7 @@ async def extract_flight(request: ChatRequest):
                 "messages": request.messages,
             },
         )
-        data = response.json()
+    data = response.json()
 
     text = data.get("content", [{}])[0].get("text", "{}")
     return {"response": text}
@@ -109,10 +223,15 @@ OPTIMIZER_URL = os.getenv(
     "OPTIMIZER_URL",
     "https://testfastapi-production-325b.up.railway.app/optimum_ef_route"
 )
+OPTIMIZER_JOBS_URL = os.getenv(
+    "OPTIMIZER_JOBS_URL",
+    OPTIMIZER_URL.rsplit("/", 1)[0] + "/jobs"
+)
+OPTIMIZER_BATCH_URL = os.getenv("OPTIMIZER_BATCH_URL", OPTIMIZER_URL + "/batch")
+OPTIMIZER_PARETO_URL = os.getenv("OPTIMIZER_PARETO_URL", OPTIMIZER_URL + "/pareto")
 
 
-@app.post("/api/optimize")
-async def optimize_route(request: OptimizeRequest):
+def build_optimizer_payload(request: OptimizeRequest):
     optimizer_payload = {
         "grid_density": 6,
         "start_long": request.start.lon,
@@ -123,15 +242,34 @@ async def optimize_route(request: OptimizeRequest):
         "duration_hours": 2, 
         "fuel_cost_per_km": 0.15,
         "lambda_value": request.lambda_value,
+        "aircraft_type": request.aircraft_type,
+        "k_routes": request.k_routes,
     }
 
+    if request.grid_config is not None:
+        optimizer_payload.update({
+            "lat_step_deg": request.grid_config.lat_step_deg,
+            "lon_step_deg": request.grid_config.lon_step_deg,
+            "altitudes_ft": request.grid_config.altitudes_ft,
+            "max_expansions": request.grid_config.max_expansions,
+            "max_lateral_change": request.grid_config.max_lateral_change,
+            "refine_levels": request.grid_config.refine_levels,
+        })
+
+    return optimizer_payload
+
+
+@app.post("/api/optimize")
+async def optimize_route(request: OptimizeRequest):
+    optimizer_payload = build_optimizer_payload(request)
+
     try:
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(
+        with observe_upstream("/api/optimize", "optimizer"):
+            response = await clients["optimizer"].post(
                 OPTIMIZER_URL,
                 json=optimizer_payload,
             )
-            data = response.json()
+        data = response.json()
 
 
         return data
@@ -142,6 +280,86 @@ async def optimize_route(request: OptimizeRequest):
         return {"error": str(e)}
 
 
+@app.post("/api/optimize/pareto")
+async def optimize_pareto(request: ParetoOptimizeRequest):
+    optimizer_payload = build_optimizer_payload(request)
+    optimizer_payload.update({
+        "lambda_values": request.lambda_values,
+        "lambda_min": request.lambda_min,
+        "lambda_max": request.lambda_max,
+        "lambda_steps": request.lambda_steps,
+        "lambda_spacing": request.lambda_spacing,
+    })
+
+    try:
+        with observe_upstream("/api/optimize/pareto", "optimizer"):
+            response = await clients["optimizer"].post(
+                OPTIMIZER_PARETO_URL,
+                json=optimizer_payload,
+            )
+        return response.json()
+    except httpx.TimeoutException:
+        return {"error": "Optimizer timed out. Try fewer lambda values or a smaller grid."}
+    except Exception as e:
+        return {"error": str(e)}
+
+
+@app.post("/api/optimize/batch")
+async def optimize_batch(requests: List[OptimizeRequest]):
+    """Stream NDJSON route results from the optimizer as each one finishes."""
+    payloads = [build_optimizer_payload(request) for request in requests]
+
+    async def lines():
+        try:
+            async with clients["optimizer"].stream(
+                "POST", OPTIMIZER_BATCH_URL, json=payloads, timeout=None
+            ) as response:
+                async for chunk in response.aiter_raw():
+                    yield chunk
+        except Exception as e:
+            yield (json.dumps({"error": str(e)}) + "\n").encode()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.post("/api/optimize/jobs")
+async def submit_optimize_job(request: OptimizeRequest):
+    try:
+        with observe_upstream("/api/optimize/jobs", "optimizer"):
+            response = await clients["optimizer"].post(
+                OPTIMIZER_JOBS_URL,
+                json=build_optimizer_payload(request),
+            )
+        return response.json()
+    except Exception as e:
+        return {"error": str(e)}
+
+
+@app.get("/api/optimize/jobs/{job_id}")
+async def get_optimize_job(job_id: str):
+    try:
+        with observe_upstream("/api/optimize/jobs/{job_id}", "optimizer"):
+            response = await clients["optimizer"].get(f"{OPTIMIZER_JOBS_URL}/{job_id}")
+        return response.json()
+    except Exception as e:
+        return {"error": str(e)}
+
+
+@app.get("/api/optimize/jobs/{job_id}/events")
+async def stream_optimize_job(job_id: str):
+    async def events():
+        try:
+            async with clients["optimizer"].stream(
+                "GET", f"{OPTIMIZER_JOBS_URL}/{job_id}/events", timeout=None
+            ) as response:
+                async for chunk in response.aiter_raw():
+                    yield chunk
+        except Exception as e:
+            yield f"event: failed\ndata: {json.dumps({'error': str(e)})}\n\n".encode()
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
 
 VERIFY_URL = os.getenv("VERIFY_URL", "http://localhost:8001/api/verifyRoute")
 
@@ -149,9 +367,9 @@ VERIFY_URL = os.getenv("VERIFY_URL", "http://localhost:8001/api/verifyRoute")
 @app.post("/api/verify")
 async def verify_route(route_payload: dict):
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(VERIFY_URL, json=route_payload)
-            return response.json()
+        with observe_upstream("/api/verify", "verify"):
+            response = await clients["verify"].post(VERIFY_URL, json=route_payload)
+        return response.json()
     except Exception:
         return {
             "status": "unverified",